@@ -1,18 +1,80 @@
 #!/usr/bin/env python3
 
 """
-Checks the number of authorized keys in /root/.ssh/authorized_keys against a stored value in
-/root/root_auth_keys.dat
+Checks the authorized keys in /root/.ssh/authorized_keys against a stored baseline in
+/root/root_auth_keys.db
+
+Each key is identified by its SHA256 fingerprint (as ssh-keygen -l prints it), so
+comments, options and blank lines do not matter, and a swapped key shows up as one
+fingerprint removed and one added. The baseline is a sqlite database of the keys each
+user on each host may have, keyed by (host, user, fingerprint), with when each key was
+first and last stored and a history of keys added and removed. Writing it only touches
+the keys that changed.
+
+The database also caches the fingerprints of each key file with its (inode, size,
+mtime, ctime): if a file still matches, it is not read at all. The ctime is there
+because anyone who can write the file can also set its mtime back, but not its ctime.
+
+With --all-users, every account in /etc/passwd is checked, in each of the key files
+sshd_config names with AuthorizedKeysFile, and the results go into one report. Key
+files are opened without following symlinks; one that is not a regular file, or is
+larger than MAX_KEY_FILE_SIZE, is reported as an error for its user and not read.
+
+With --watch, it reports on the keys as they are, then keeps running, and uses inotify
+to re-check a user's keys as soon as one of their key files changes, sleeping in
+between.
 """
 import yaml
 import pprint
 import argparse
+import base64
+import hashlib
+import shlex
+import socket
+import sqlite3
+import time
+import pwd
+import ctypes
+import errno
+import select
+import stat
+import struct
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from termcolor import cprint
 
-#STOREFILE = '/root/root_auth_keys.dat'
+#STOREFILE = '/root/root_auth_keys.db'
+
+# what sshd uses when sshd_config has no AuthorizedKeysFile
+DEFAULT_KEY_FILES = ['.ssh/authorized_keys', '.ssh/authorized_keys2']
+# key files larger than this are not read; no real one comes close
+MAX_KEY_FILE_SIZE = 1 << 20
+
+# inotify event bits, from <sys/inotify.h>
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x80000
+# everything that can change what is in a directory's files, or the directory itself
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+# struct inotify_event: int wd; uint32 mask, cookie, len; char name[len]
+INOTIFY_EVENT = struct.Struct('iIII')
+# how long to wait for more events after one arrives, so an editor's write, rename
+# and chmod are checked once
+WATCH_SETTLE = 0.2
+# and the longest to keep waiting, from the first event, when they keep coming
+WATCH_SETTLE_MAX = 2.0
 
 def check_root_privileges() -> None:
     """
@@ -24,32 +86,506 @@ def check_root_privileges() -> None:
         print("Usage: sudo ./install-cpan-modules.py [options]")
         sys.exit(1)
 
-def get_line_count(afile: str) -> int:
+def parse_key_line(line: str):
+  """
+  Parse one authorized_keys line: [options] keytype base64-key [comment]
+
+  The key type is found by checking each word against the type name encoded at
+  the start of the key blob that should follow it, so options (quoted or not)
+  and new key types need no special casing.
+
+  Returns:
+    (keytype, blob) or None for blank lines, comments and lines with no key
+  """
+  line = line.strip()
+  if not line or line.startswith('#'):
+    return None
+  try:
+    words = shlex.split(line, posix=False)
+  except ValueError:
+    words = line.split()
+  for (i, word) in enumerate(words[:-1]):
+    try:
+      blob = base64.b64decode(words[i + 1], validate=True)
+    except ValueError:
+      continue
+    # the blob starts with the key type as an SSH string: uint32 length, bytes
+    size = int.from_bytes(blob[:4], 'big')
+    if blob[4:4 + size] == word.encode():
+      return (word, blob)
+  return None
+
+
+def fingerprint(blob: bytes) -> str:
+  """
+  Returns:
+    the SHA256 fingerprint of a key blob, as ssh-keygen prints it
+  """
+  return 'SHA256:' + base64.b64encode(hashlib.sha256(blob).digest()).decode().rstrip('=')
+
+
+def get_fingerprints(lines) -> set:
+  """
+  Get the fingerprints of the keys in the lines of an authorized_keys file
+  """
+  fps = set()
+  for line in lines:
+    key = parse_key_line(line)
+    if key:
+      fps.add(fingerprint(key[1]))
+  return fps
+
+
+def open_key_file(afile: str) -> tuple:
+  """
+  Open a key file without following a symlink or blocking on a FIFO, and check
+  that it is a regular file of at most MAX_KEY_FILE_SIZE bytes.
+
+  Returns:
+    (fd, stat result)
+  """
+  fd = os.open(afile, os.O_RDONLY | os.O_NONBLOCK | os.O_NOFOLLOW | os.O_CLOEXEC)
+  try:
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode):
+      raise OSError(errno.EINVAL, "not a regular file", afile)
+    if st.st_size > MAX_KEY_FILE_SIZE:
+      raise OSError(errno.EFBIG, "larger than {0} bytes".format(MAX_KEY_FILE_SIZE), afile)
+  except OSError:
+    os.close(fd)
+    raise
+  return (fd, st)
+
+
+def file_signature(st: os.stat_result) -> list:
+  """
+  Returns:
+    [inode, size, mtime_ns, ctime_ns] from a key file's stat(); if these are unchanged,
+    so are its keys
+  """
+  return [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+
+def current_keys(afile: str, stored: dict) -> tuple:
   """
-  Get the line count, aka number of keys, if the authorized_keys file
+  Get the fingerprints in a key file, without reading it if its signature
+  matches the stored one.
+
+  Returns:
+    (fingerprints, signature, cached): cached is True if the file was not read
   """
-  count = len(open(afile).readlines( ))
-  return count
+  (fd, st) = open_key_file(afile)
+  with os.fdopen(fd, 'rb') as f:
+    sig = file_signature(st)
+    if stored and stored.get('signature') == sig:
+      return (set(stored.get('fingerprints', [])), sig, True)
+    # it may have grown since fstat()
+    data = f.read(MAX_KEY_FILE_SIZE + 1)
+  if len(data) > MAX_KEY_FILE_SIZE:
+    raise OSError(errno.EFBIG, "larger than {0} bytes".format(MAX_KEY_FILE_SIZE), afile)
+  return (get_fingerprints(data.decode(errors='replace').splitlines()), sig, False)
+
+
+def get_users(passwd_file: str = '/etc/passwd') -> list:
+  """
+  Read the accounts from a passwd file, once.
+
+  Returns:
+    list of (user, home)
+  """
+  users = list()
+  with open(passwd_file, 'r') as f:
+    for line in f:
+      fields = line.rstrip('\n').split(':')
+      if len(fields) < 7 or fields[0].startswith('#'):
+        continue
+      users.append((fields[0], fields[5]))
+  return users
+
+
+def get_key_file_patterns(sshd_config: str = '/etc/ssh/sshd_config') -> list:
+  """
+  Get the AuthorizedKeysFile patterns from sshd_config. Only the global setting is
+  used: anything after the first Match block applies to some connections only.
+
+  Returns:
+    list of patterns, with %h, %u and %% still in them
+  """
+  try:
+    with open(sshd_config, 'r') as f:
+      for line in f:
+        words = line.split()
+        if not words or words[0].startswith('#'):
+          continue
+        keyword = words[0].lower()
+        if keyword == 'match':
+          break
+        # sshd uses the first value it sees for a keyword
+        if keyword == 'authorizedkeysfile' and len(words) > 1:
+          return [w for w in words[1:] if w.lower() != 'none']
+  except FileNotFoundError:
+    pass
+  return list(DEFAULT_KEY_FILES)
+
+
+def expand_key_file(pattern: str, user: str, home: str) -> str:
+  """
+  Expand an AuthorizedKeysFile pattern the way sshd does: %h is the home directory,
+  %u the user name, %% a literal %, and a relative path is relative to the home
+  directory.
+  """
+  path = pattern.replace('%%', '\0').replace('%h', home).replace('%u', user).replace('\0', '%')
+  return path if os.path.isabs(path) else os.path.join(home, path)
+
+
+def all_key_files(passwd_file: str, sshd_config: str) -> list:
+  """
+  Returns:
+    list of (user, path) for every account and AuthorizedKeysFile, without repeats
+  """
+  patterns = get_key_file_patterns(sshd_config)
+  seen = set()
+  targets = list()
+  for (user, home) in get_users(passwd_file):
+    for pattern in patterns:
+      path = expand_key_file(pattern, user, home)
+      if path not in seen:
+        seen.add(path)
+        targets.append((user, path))
+  return targets
+
+
+def scan_key_files(targets: list, stored: dict, jobs: int = 16) -> dict:
+  """
+  Get the current keys of many key files with a bounded thread pool. Most files
+  are unchanged and only stat()ed; the rest are read and hashed in parallel.
+
+  Returns:
+    path -> (user, fingerprints, signature, cached, error); a file that does not
+    exist has no keys and a signature of None, and one that cannot be read the
+    same, with why in error
+  """
+  def scan(target):
+    (user, path) = target
+    try:
+      return (path, (user,) + current_keys(path, stored.get(path)) + (None,))
+    except FileNotFoundError:
+      return (path, (user, set(), None, False, None))
+    except OSError as err:
+      return (path, (user, set(), None, False, str(err)))
+
+  with ThreadPoolExecutor(max_workers=jobs) as pool:
+    return dict(pool.map(scan, targets))
+
+
+class Inotify:
+  """
+  Just enough of inotify, through libc with ctypes, to watch directories.
+  """
+
+  def __init__(self):
+    self.libc = ctypes.CDLL(None, use_errno=True)
+    self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+    if self.fd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, "inotify_init1: " + os.strerror(err))
+
+  def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+    """
+    Returns:
+      the watch descriptor
+    """
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+    if wd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err), path)
+    return wd
+
+  def read(self, timeout: float = None) -> list:
+    """
+    Wait up to timeout seconds (forever if None) for events, and read them.
+
+    Returns:
+      list of (wd, mask, name)
+    """
+    if not select.select([self.fd], [], [], timeout)[0]:
+      return []
+    data = os.read(self.fd, 65536)
+    events = list()
+    offset = 0
+    while offset < len(data):
+      (wd, mask, cookie, size) = INOTIFY_EVENT.unpack_from(data, offset)
+      offset += INOTIFY_EVENT.size
+      name = data[offset:offset + size].rstrip(b'\0')
+      offset += size
+      events.append((wd, mask, os.fsdecode(name)))
+    return events
+
+
+def check_user(db: sqlite3.Connection, host: str, user: str, files: list, cache: dict) -> tuple:
+  """
+  Check one user's key files against their baseline, reading only the files
+  whose signature changed, and update the file cache.
+
+  Returns:
+    (added, removed, paths, errors): the fingerprints not in and missing from
+    the baseline, fingerprint -> the key file it is in, and path -> why it
+    could not be read; with errors, nothing is compared
+  """
+  results = scan_key_files([(user, path) for path in files], cache, 1)
+  for (path, (_, fps, sig, cached, error)) in results.items():
+    if sig is None:
+      cache.pop(path, None)
+    else:
+      cache[path] = {'fingerprints': sorted(fps), 'signature': sig}
+  save_cache(db, host, results)
+  db.commit()
+  errors = dict((path, r[4]) for (path, r) in results.items() if r[4])
+  if errors:
+    return (set(), set(), dict(), errors)
+  fps = set()
+  paths = dict()
+  for (path, (_, found, sig, cached, error)) in results.items():
+    fps.update(found)
+    paths.update((fp, path) for fp in found)
+  old = load_baseline(db, host, [user]).get(user, set())
+  return (fps - old, old - fps, paths, errors)
+
+
+def watch_keys(db: sqlite3.Connection, host: str, targets: list, cache: dict,
+               quiet: bool = False, verbose: bool = False) -> None:
+  """
+  Watch the key files of the given users and report as soon as a user's keys stop
+  matching their baseline. The parent directory of each key file is watched, which
+  catches the file being written, replaced by a rename, created or deleted; if
+  the directory does not exist yet, its parent is watched for it to be created.
+  Only the user whose file changed is checked again. Between events this sleeps
+  in select(), so it uses no CPU.
+
+  Runs until interrupted.
+  """
+  inotify = Inotify()
+  users = dict()
+  by_dir = dict()
+  for (user, path) in targets:
+    users.setdefault(user, list()).append(path)
+    by_dir.setdefault(os.path.dirname(path), set()).add(user)
+  dirs = dict()
+
+  def watch(d):
+    # watch d, or the nearest parent that exists, for d to appear
+    while d:
+      try:
+        dirs[inotify.add_watch(d)] = d
+        return
+      except FileNotFoundError:
+        if os.path.dirname(d) == d:
+          return
+        d = os.path.dirname(d)
+
+  for d in by_dir:
+    watch(d)
+  if verbose:
+    cprint("Watching {0} key files in {1} directories".format(len(targets), len(dirs)), "green")
+
+  while True:
+    events = inotify.read()
+    # let a burst of events settle, then check each user once; a file that is
+    # written to all the time is still checked every WATCH_SETTLE_MAX seconds
+    deadline = time.monotonic() + WATCH_SETTLE_MAX
+    while True:
+      left = deadline - time.monotonic()
+      if left <= 0:
+        break
+      more = inotify.read(min(WATCH_SETTLE, left))
+      if not more:
+        break
+      events.extend(more)
+    changed = set()
+    for (wd, mask, name) in events:
+      d = dirs.get(wd)
+      if d is None:
+        continue
+      path = os.path.join(d, name) if name else d
+      if mask & IN_IGNORED or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+        # the directory went away: watch for it to come back
+        dirs.pop(wd, None)
+        watch(os.path.dirname(d))
+        changed.update(by_dir.get(d, ()))
+        continue
+      if path in by_dir:
+        # a key file directory was created (or removed)
+        watch(path)
+        changed.update(by_dir[path])
+      elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+        # or a directory above some
+        for (kd, kusers) in by_dir.items():
+          if kd.startswith(path + os.sep):
+            watch(kd)
+            changed.update(kusers)
+      changed.update(user for user in by_dir.get(d, ()) if path in users[user])
+    for user in sorted(changed):
+      (added, removed, paths, errors) = check_user(db, host, user, users[user], cache)
+      stamp = time.strftime('%Y-%m-%d %H:%M:%S')
+      if errors:
+        cprint("{0} {1}: cannot check keys".format(stamp, user), "red")
+        for (path, error) in sorted(errors.items()):
+          cprint("! {0}: {1}".format(path, error), "red")
+      elif added or removed:
+        cprint("{0} {1}: keys changed".format(stamp, user), "red")
+        for fp in sorted(added):
+          cprint("+ {0} {1}".format(fp, paths[fp]), "red")
+        for fp in sorted(removed):
+          cprint("- " + fp, "yellow")
+      elif not quiet:
+        cprint("{0} {1}: keys match the stored set".format(stamp, user), "green")
+      sys.stdout.flush()
+
+
+def open_db(db_file: str) -> sqlite3.Connection:
+  """
+  Open (and create, if needed) the baseline database.
+
+  keys: the baseline, one row per key a user may have on a host
+  history: keys added to and removed from the baseline
+  files: the fingerprints last read from each key file, with its signature
+  """
+  db = sqlite3.connect(db_file)
+  db.execute("CREATE TABLE IF NOT EXISTS keys (host TEXT, user TEXT, fingerprint TEXT, path TEXT, "
+             "first_seen INTEGER, last_seen INTEGER, PRIMARY KEY (host, user, fingerprint))")
+  db.execute("CREATE TABLE IF NOT EXISTS history (host TEXT, user TEXT, fingerprint TEXT, path TEXT, "
+             "change TEXT, at INTEGER)")
+  db.execute("CREATE INDEX IF NOT EXISTS history_host_user ON history (host, user, at)")
+  db.execute("CREATE TABLE IF NOT EXISTS files (host TEXT, path TEXT, inode INTEGER, size INTEGER, "
+             "mtime_ns INTEGER, fingerprints TEXT, ctime_ns INTEGER, PRIMARY KEY (host, path))")
+  # databases from before ctime_ns was part of the signature; their files are read again once
+  if 'ctime_ns' not in [row[1] for row in db.execute("PRAGMA table_info(files)")]:
+    db.execute("ALTER TABLE files ADD COLUMN ctime_ns INTEGER")
+  return db
+
+
+def load_cache(db: sqlite3.Connection, host: str) -> dict:
+  """
+  Returns:
+    path -> {'fingerprints': [...], 'signature': [inode, size, mtime_ns, ctime_ns]}, for current_keys()
+  """
+  rows = db.execute("SELECT path, inode, size, mtime_ns, ctime_ns, fingerprints FROM files WHERE host = ?", (host,))
+  return dict((path, {'fingerprints': fps.split(), 'signature': [inode, size, mtime_ns, ctime_ns]})
+              for (path, inode, size, mtime_ns, ctime_ns, fps) in rows)
+
+
+def save_cache(db: sqlite3.Connection, host: str, results: dict) -> None:
+  """
+  Store the fingerprints of the key files that were read this run, and forget the
+  ones that are gone.
+  """
+  db.executemany("INSERT OR REPLACE INTO files (host, path, inode, size, mtime_ns, ctime_ns, fingerprints) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                 [(host, path, sig[0], sig[1], sig[2], sig[3], ' '.join(sorted(fps)))
+                  for (path, (user, fps, sig, cached, error)) in results.items() if sig is not None and not cached])
+  db.executemany("DELETE FROM files WHERE host = ? AND path = ?",
+                 [(host, path) for (path, r) in results.items() if r[2] is None])
+
+
+def load_baseline(db: sqlite3.Connection, host: str, users: list = None) -> dict:
+  """
+  Get the stored keys of some users on a host, or of all of them, through the
+  (host, user, fingerprint) index.
+
+  Returns:
+    user -> set of fingerprints
+  """
+  baseline = dict()
+  if users is None:
+    rows = db.execute("SELECT user, fingerprint FROM keys WHERE host = ?", (host,))
+  else:
+    rows = list()
+    for user in users:
+      rows.extend(db.execute("SELECT user, fingerprint FROM keys WHERE host = ? AND user = ?", (host, user)))
+  for (user, fp) in rows:
+    baseline.setdefault(user, set()).add(fp)
+  return baseline
+
+
+def save_baseline(db: sqlite3.Connection, host: str, current: dict, baseline: dict, paths: dict) -> int:
+  """
+  Bring the stored keys of the given users up to date: insert the new keys, bump
+  last_seen on the ones still there, delete the ones that are gone, and record
+  the additions and removals in history. Other users and hosts are not touched.
+
+  Args:
+    current: user -> set of fingerprints now
+    baseline: user -> set of fingerprints stored, from load_baseline()
+    paths: (user, fingerprint) -> the key file it was found in
+
+  Returns:
+    the number of keys added or removed
+  """
+  now = int(time.time())
+  added = list()
+  kept = list()
+  removed = list()
+  for (user, fps) in current.items():
+    old = baseline.get(user, set())
+    added.extend((host, user, fp, paths.get((user, fp))) for fp in fps - old)
+    kept.extend((now, paths.get((user, fp)), host, user, fp) for fp in fps & old)
+    removed.extend((host, user, fp) for fp in old - fps)
+  with db:
+    db.executemany("INSERT INTO keys (host, user, fingerprint, path, first_seen, last_seen) VALUES (?, ?, ?, ?, ?, ?)",
+                   [r + (now, now) for r in added])
+    db.executemany("UPDATE keys SET last_seen = ?, path = ? WHERE host = ? AND user = ? AND fingerprint = ?", kept)
+    db.executemany("DELETE FROM keys WHERE host = ? AND user = ? AND fingerprint = ?", removed)
+    db.executemany("INSERT INTO history (host, user, fingerprint, path, change, at) VALUES (?, ?, ?, ?, ?, ?)",
+                   [r + ('added', now) for r in added] + [r + (None, 'removed', now) for r in removed])
+  return len(added) + len(removed)
 
 
 def read_dat(store_file: str) -> dict:
+  """
+  Read a YAML data file from the older versions of this script: key file path ->
+  {'fingerprints': [...], 'signature': [...], 'user': ...}
+
+  Returns:
+    the stored data, or an empty dict if there is none (or it is in an older format)
+  """
   with open(store_file, 'r') as stream:
-    try:
-      print(yaml.safe_load(stream))
-    except yaml.YAMLError as exc:
-      print(exc)
+    data = yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+  return data if isinstance(data, dict) else dict()
 
 
-def write_dat(yamldict: dict, store_file: str, debug: bool=False) -> bool:
-  if debug:
-    print("DEBUG: Data to be written: ")
-    documents = yaml.dump(yamldict)
-    print(documents)
-    print("DEBUG: Writing the following data to " + store_file)
-    pprint.pprint(yamldict)
-  with open(store_file, 'w') as out:
-    yaml.dump(yamldict, out)
-  return True
+def import_dat(db: sqlite3.Connection, host: str, store_file: str) -> int:
+  """
+  Import a YAML data file into the baseline for a host. Keys are filed under the
+  user the file names, or else the owner of the key file.
+
+  Returns:
+    the number of keys added or removed
+  """
+  current = dict()
+  paths = dict()
+  for (path, entry) in read_dat(store_file).items():
+    if not isinstance(entry, dict):
+      continue
+    user = entry.get('user') or file_owner(path)
+    for fp in entry.get('fingerprints', []):
+      current.setdefault(user, set()).add(fp)
+      paths[(user, fp)] = path
+  return save_baseline(db, host, current, load_baseline(db, host, list(current)), paths)
+
+
+def file_owner(path: str) -> str:
+  """
+  Returns:
+    the name of the user owning a file, its uid if it has no name, or '?' if the
+    file does not exist
+  """
+  try:
+    uid = os.stat(path).st_uid
+  except OSError:
+    return '?'
+  try:
+    return pwd.getpwuid(uid).pw_name
+  except KeyError:
+    return str(uid)
 
 
 def main():
@@ -65,20 +601,136 @@ def main():
   vqd.add_argument("-v", "--verbose", dest="verbose", required=False, action='store_true', help="increase output verbosity")
   vqd.add_argument("-q", "--quiet", dest="quiet", required=False, action="store_true", help="suppress output except for errors")
   vqd.add_argument("-D", "--debug", dest="debug", required=False, action='store_true', help="enable debug output")
-  parser.add_argument("-w", "--write", dest="write", required=False, action='store_true', help="write current count to data file")
-  parser.add_argument('-s', '--show-only', dest='showonly', required=False, action='store_true', help='show current count without writing to data file')
-  parser.add_argument('-d', '--db-file', dest='dbfile', default='/root/root_auth_keys.dat', required=False, help='specify alternate data file location')
+  parser.add_argument("-w", "--write", dest="write", required=False, action='store_true', help="write current keys to the baseline")
+  parser.add_argument('-s', '--show-only', dest='showonly', required=False, action='store_true', help='show current keys without checking or writing the baseline')
+  parser.add_argument('-d', '--db-file', dest='dbfile', default='/root/root_auth_keys.db', required=False, help='specify alternate baseline database location')
+  parser.add_argument('-H', '--host', dest='host', default=socket.gethostname(), required=False, help='host name to file the keys under (default: this host)')
+  parser.add_argument('--import-yaml', dest='importyaml', required=False, help='import a YAML .dat file from older versions of this script into the baseline, and exit')
+  parser.add_argument('--history', dest='history', type=int, nargs='?', const=50, required=False, help='show the last HISTORY (default 50) keys added to or removed from the baseline, and exit')
   parser.add_argument('-a', '--authfile', dest='authfile', default='/root/.ssh/authorized_keys', required=False, help='specify alternate authorized_keys file location')
+  parser.add_argument('-A', '--all-users', dest='allusers', required=False, action='store_true', help='check the key files of every account in the passwd file instead of --authfile')
+  parser.add_argument('-W', '--watch', dest='watch', required=False, action='store_true', help='keep running, and check a user\'s keys against the baseline whenever one of their key files changes')
+  parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=16, required=False, help='threads to read key files with (default: 16)')
+  parser.add_argument('--passwd', dest='passwd', default='/etc/passwd', required=False, help='specify alternate passwd file location, for --all-users')
+  parser.add_argument('--sshd-config', dest='sshdconfig', default='/etc/ssh/sshd_config', required=False, help='specify alternate sshd_config location, for --all-users')
   args = parser.parse_args()
 
   if args.debug:
     print("DEBUG: Arguments parsed:")
     pp.pprint(vars(args))
 
-  stored = read_dat(args.dbfile)
-  cnt = get_line_count(args.authfile)
-  print("Current count is " + str(cnt))  
+  try:
+    db = open_db(args.dbfile)
+    if args.importyaml:
+      changes = import_dat(db, args.host, args.importyaml)
+      if not args.quiet:
+        cprint("Imported {0} into the baseline for {1}: {2} keys added or removed".format(args.importyaml, args.host, changes), "green")
+      return
+    if args.history:
+      rows = db.execute("SELECT at, user, change, fingerprint, path FROM history WHERE host = ? ORDER BY at DESC, rowid DESC LIMIT ?",
+                        (args.host, args.history))
+      for (at, user, change, fp, path) in rows:
+        print("{0} {1} {2} {3} {4}".format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(at)), user, change, fp, path or ''))
+      return
+    cache = load_cache(db, args.host)
+  except (OSError, sqlite3.Error, yaml.YAMLError) as err:
+    cprint("ERROR: {0}".format(err), "red")
+    sys.exit(2)
+
+  try:
+    if args.allusers:
+      targets = all_key_files(args.passwd, args.sshdconfig)
+    else:
+      targets = [(file_owner(args.authfile), args.authfile)]
+    results = scan_key_files(targets, cache, args.jobs)
+  except OSError as err:
+    cprint("ERROR: {0}".format(err), "red")
+    sys.exit(2)
+  if not args.allusers and results[args.authfile][4]:
+    cprint("ERROR: {0}".format(results[args.authfile][4]), "red")
+    sys.exit(2)
+  if not args.allusers and results[args.authfile][2] is None:
+    cprint("ERROR: {0} not found".format(args.authfile), "red")
+    sys.exit(2)
+  if args.debug:
+    for (path, (user, fps, sig, cached, error)) in results.items():
+      print("DEBUG: {0} {1}".format(path, error or ("unchanged, not read" if cached else "read")))
+  save_cache(db, args.host, results)
+  db.commit()
+
+  if args.showonly:
+    for (path, (user, fps, sig, cached, error)) in results.items():
+      if error:
+        cprint("{0} ({1}): {2}".format(path, user, error), "red")
+      elif sig is not None:
+        print("{0} ({1}): current count is {2}".format(path, user, len(fps)))
+        for fp in sorted(fps):
+          print("  " + fp)
+    return
+
+  # the keys each user has now, across all of their key files; a user with a key
+  # file that could not be read is neither checked nor written
+  errors = dict()
+  for (path, (user, fps, sig, cached, error)) in results.items():
+    if error:
+      errors.setdefault(user, list()).append((path, error))
+  current = dict()
+  paths = dict()
+  for (path, (user, fps, sig, cached, error)) in results.items():
+    if user not in errors:
+      current.setdefault(user, set()).update(fps)
+      paths.update(((user, fp), path) for fp in fps)
+  baseline = load_baseline(db, args.host, None if args.allusers else list(current))
+
+  if args.write:
+    changes = save_baseline(db, args.host, current, baseline, paths)
+    if not args.quiet:
+      cprint("Stored {0} keys for {1} users ({2} added or removed)".format(sum(len(f) for f in current.values()), len(current), changes), "green")
+    for user in sorted(errors):
+      cprint("{0}: not stored, cannot read {1}".format(user, ", ".join("{0} ({1})".format(*e) for e in errors[user])), "red")
+    if errors:
+      sys.exit(1)
+    return
+
+  if not baseline:
+    cprint("No stored keys for {0}; run with --write first".format(args.host), "yellow")
+    sys.exit(2)
+  changed = len(errors)
+  for user in sorted(errors):
+    cprint("{0}: cannot check keys".format(user), "red")
+    for (path, error) in errors[user]:
+      cprint("! {0}: {1}".format(path, error), "red")
+  for user in sorted(current):
+    fps = current[user]
+    old = baseline.get(user, set())
+    added = fps - old
+    removed = old - fps
+    if added or removed:
+      changed += 1
+    if args.quiet:
+      continue
+    if added or removed or args.verbose or not args.allusers:
+      print("{0}: current count is {1}".format(user, len(fps)))
+    for fp in sorted(added):
+      cprint("+ {0} {1}".format(fp, paths[(user, fp)]), "red")
+    for fp in sorted(removed):
+      cprint("- " + fp, "yellow")
+  if not args.quiet and not changed:
+    cprint("Keys match the stored set", "green")
+
+  if args.watch:
+    # the keys as they are now were checked above; from here on, only changes
+    sys.stdout.flush()
+    cache.update((path, {'fingerprints': sorted(fps), 'signature': sig})
+                 for (path, (user, fps, sig, cached, error)) in results.items() if sig is not None)
+    try:
+      watch_keys(db, args.host, targets, cache, args.quiet, args.verbose or args.debug)
+    except KeyboardInterrupt:
+      pass
+    except OSError as err:
+      cprint("ERROR: {0}".format(err), "red")
+      sys.exit(2)
+  sys.exit(1 if changed else 0)
 
 if __name__=='__main__':
   main()
-
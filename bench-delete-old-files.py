@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+bench-delete-old-files.py
+
+Build a reproducible synthetic directory tree (on tmpfs by default), then
+time delete-old-files.py against it, so that changes to the scan and
+delete paths can be compared run over run.
+
+For each run this reports wall time, files/sec and the peak RSS of the
+child, and optionally its syscall count from a separate pass under
+`strace -c -f`. Results are appended as one JSON object per line to the
+--output file.
+
+Usage:
+  ./bench-delete-old-files.py --depth 3 --fanout 8 --files 50 --repeat 3
+  ./bench-delete-old-files.py --strace --args "-j 4" -o bench.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shlex
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+from typing import Dict, List, Optional
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'delete-old-files.py')
+
+
+def file_age(rng: random.Random, dist: str, max_age: float) -> float:
+    """
+    Pick the age of one file, in days.
+
+    Args:
+        rng: seeded random source
+        dist: 'uniform' over [0, max_age], or 'exponential' with a mean of
+            max_age / 4, capped at max_age
+        max_age: oldest age to generate
+
+    Returns:
+        age in days
+    """
+    if dist == 'exponential':
+        return min(max_age, rng.expovariate(4.0 / max_age))
+    return rng.uniform(0, max_age)
+
+
+def build_tree(root: str, depth: int, fanout: int, files: int, file_size: int,
+               dist: str, max_age: float, seed: int) -> Dict[str, int]:
+    """
+    Build the synthetic tree under root. Every directory holds `files`
+    files and, above `depth`, `fanout` subdirectories. Files and
+    directories get mtimes from the age distribution via os.utime, the
+    directories after their contents so the mtimes stick.
+
+    Returns:
+        dict with the number of dirs and files created
+    """
+    rng = random.Random(seed)
+    now = time.time()
+    data = b'\0' * file_size
+    counts = {'dirs': 0, 'files': 0}
+
+    def populate(path: str, level: int) -> None:
+        os.makedirs(path, exist_ok=True)
+        counts['dirs'] += 1
+        for i in range(files):
+            fqfile = os.path.join(path, 'f{0:05d}.dat'.format(i))
+            with open(fqfile, 'wb') as f:
+                f.write(data)
+            t = now - file_age(rng, dist, max_age) * 86400
+            os.utime(fqfile, (t, t))
+            counts['files'] += 1
+        if level < depth:
+            for i in range(fanout):
+                populate(os.path.join(path, 'd{0:03d}'.format(i)), level + 1)
+        t = now - file_age(rng, dist, max_age) * 86400
+        os.utime(path, (t, t))
+
+    populate(root, 0)
+    return counts
+
+
+def run_once(cmd: List[str]) -> Dict[str, float]:
+    """
+    Run a command with its output discarded, and measure it.
+
+    Returns:
+        dict with wall seconds, peak RSS in KiB and the exit status
+    """
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    (_, status, rusage) = os.wait4(proc.pid, 0)
+    seconds = time.monotonic() - start
+    return {'seconds': seconds, 'max_rss_kb': rusage.ru_maxrss, 'status': os.waitstatus_to_exitcode(status)}
+
+
+def count_syscalls(cmd: List[str]) -> Optional[int]:
+    """
+    Run a command under `strace -c -f` and total up its syscalls.
+
+    Returns:
+        number of syscalls, or None if strace is not available
+    """
+    if not shutil.which('strace'):
+        return None
+    with tempfile.NamedTemporaryFile('r', suffix='.strace') as out:
+        subprocess.run(['strace', '-c', '-f', '-o', out.name] + cmd,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for line in out:
+            # the summary line looks like: 100.00  0.01  1  12345  67  total
+            fields = line.split()
+            if fields and fields[-1] == 'total':
+                return int(fields[3])
+    return None
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark delete-old-files.py against a synthetic tree.")
+    parser.add_argument('-t', '--tmpdir', dest='tmpdir', default='/dev/shm' if os.path.isdir('/dev/shm') else None, help="Where to build the tree (default: /dev/shm).")
+    parser.add_argument('--depth', dest='depth', type=int, default=3, help="Levels of subdirectories below the root.")
+    parser.add_argument('--fanout', dest='fanout', type=int, default=8, help="Subdirectories per directory.")
+    parser.add_argument('--files', dest='files', type=int, default=50, help="Files per directory.")
+    parser.add_argument('--file-size', dest='filesize', type=int, default=0, help="Bytes written to each file.")
+    parser.add_argument('--dist', dest='dist', choices=['uniform', 'exponential'], default='uniform', help="Distribution of file ages.")
+    parser.add_argument('--max-age', dest='maxage', type=float, default=365, help="Oldest file age to generate, in days.")
+    parser.add_argument('--seed', dest='seed', type=int, default=42, help="Seed for the tree layout and ages.")
+    parser.add_argument('--mode', dest='modes', action='append', choices=['scan', 'delete'], help="Paths to benchmark: scan (--report) and/or delete. Default both.")
+    parser.add_argument('--repeat', dest='repeat', type=int, default=1, help="Runs per mode.")
+    parser.add_argument('--args', dest='extra', default='', help="Extra arguments for delete-old-files.py, e.g. \"-j 4 -a 90\".")
+    parser.add_argument('--strace', dest='strace', action='store_true', help="Also count syscalls with an extra run under strace -c -f.")
+    parser.add_argument('-o', '--output', dest='output', help="Append the results to this file as a JSON line.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    modes = args.modes or ['scan', 'delete']
+    extra = shlex.split(args.extra)
+    tree_params = {k: getattr(args, k) for k in ('depth', 'fanout', 'files', 'filesize', 'dist', 'maxage', 'seed')}
+
+    result = {
+        'timestamp': int(time.time()),
+        'host': socket.gethostname(),
+        'python': sys.version.split()[0],
+        'params': dict(tree_params, args=extra),
+        'runs': list(),
+    }
+
+    workdir = tempfile.mkdtemp(prefix='bench-dof-', dir=args.tmpdir)
+    root = os.path.join(workdir, 'tree')
+
+    def fresh_tree() -> Dict[str, int]:
+        # deleting changes the tree, so every run starts from a new one
+        shutil.rmtree(root, ignore_errors=True)
+        return build_tree(root, args.depth, args.fanout, args.files, args.filesize,
+                          args.dist, args.maxage, args.seed)
+
+    try:
+        for mode in modes:
+            cmd = [sys.executable, SCRIPT, '-d', root] + extra
+            if mode == 'scan':
+                cmd.append('--report')
+            for n in range(args.repeat):
+                start = time.monotonic()
+                counts = fresh_tree()
+                result['tree'] = dict(counts, build_seconds=round(time.monotonic() - start, 3))
+                run = run_once(cmd)
+                run.update({'mode': mode, 'run': n + 1,
+                            'files_per_sec': round(counts['files'] / run['seconds'], 1) if run['seconds'] else None})
+                run['seconds'] = round(run['seconds'], 4)
+                if args.strace:
+                    fresh_tree()
+                    run['syscalls'] = count_syscalls(cmd)
+                result['runs'].append(run)
+                print("{mode} #{run}: {seconds}s, {files_per_sec} files/sec, {max_rss_kb} KiB peak RSS".format(**run)
+                      + (", {0} syscalls".format(run['syscalls']) if run.get('syscalls') is not None else ''))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'a') as out:
+            out.write(json.dumps(result) + '\n')
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
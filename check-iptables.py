@@ -1,17 +1,1422 @@
 #!/usr/bin/env python3
+"""
+Compare the local iptables rules against a template.
 
+Both the template and the local rules are in `iptables-save` format. Each
+is parsed into canonical per-table, per-chain rule records (option order,
+CIDR masks, protocol and port aliases normalized), and the missing and
+extra rules in each chain are found with hashed multiset lookups, so the
+diff stays linear in the number of rules.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import hashlib
+import itertools
+import socket
 import pprint
 import argparse
+import ipaddress
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter, defaultdict, deque, namedtuple
 
+# a rule as found in a dump: where it lives, its canonical key, the line as
+# written (without counters), its counters if any, and the parsed spec
+Rule = namedtuple('Rule', ['table', 'chain', 'key', 'text', 'packets', 'bytes', 'spec'])
+
+# the canonical form of a rule's options, each as (negated, option, values):
+# the basic matches, (module, options) per match module, and the target
+Spec = namedtuple('Spec', ['basic', 'modules', 'target'])
+
+# the part of the packet space a rule matches, as far as we can tell: each
+# field is None when the rule does not restrict it (or negates it), and
+# extra holds the (module, option) matches that are not modelled here
+Match = namedtuple('Match', ['proto', 'src', 'dst', 'iface_in', 'iface_out', 'sports', 'dports', 'ctstate', 'extra'])
+
+# the differences in one chain: (template, local) policies if they differ,
+# and the rules missing from or extra to the local chain
+ChainDiff = namedtuple('ChainDiff', ['table', 'chain', 'policy', 'missing', 'extra'])
+
+# options that are not part of a match module
+BASIC_OPTS = {'-p', '-s', '-d', '-i', '-o', '-f', '-c'}
+
+OPT_ALIASES = {
+    '--protocol': '-p',
+    '--source': '-s', '--src': '-s',
+    '--destination': '-d', '--dst': '-d',
+    '--in-interface': '-i',
+    '--out-interface': '-o',
+    '--fragment': '-f',
+    '--set-counters': '-c',
+    '--match': '-m',
+    '--jump': '-j',
+    '--goto': '-g',
+    '--source-port': '--sport',
+    '--destination-port': '--dport',
+    '--source-ports': '--sports',
+    '--destination-ports': '--dports',
+}
+
+PROTO_ALIASES = {
+    '1': 'icmp', '6': 'tcp', '17': 'udp', '47': 'gre', '50': 'esp',
+    '51': 'ah', '58': 'ipv6-icmp', '132': 'sctp', 'icmpv6': 'ipv6-icmp',
+}
+
+ICMP_TYPES = {
+    'any': '255', 'echo-reply': '0', 'pong': '0', 'destination-unreachable': '3',
+    'source-quench': '4', 'redirect': '5', 'echo-request': '8', 'ping': '8',
+    'router-advertisement': '9', 'router-solicitation': '10', 'time-exceeded': '11',
+    'ttl-exceeded': '11', 'parameter-problem': '12', 'timestamp-request': '13',
+    'timestamp-reply': '14',
+}
+
+# so that templates can name ports without relying on /etc/services
+SERVICES = {
+    'ftp-data': 20, 'ftp': 21, 'ssh': 22, 'telnet': 23, 'smtp': 25, 'domain': 53,
+    'dns': 53, 'bootps': 67, 'bootpc': 68, 'tftp': 69, 'http': 80, 'pop3': 110,
+    'ntp': 123, 'imap': 143, 'snmp': 161, 'ldap': 389, 'https': 443,
+    'smtps': 465, 'submission': 587, 'ldaps': 636, 'imaps': 993, 'pop3s': 995,
+    'mysql': 3306, 'postgresql': 5432,
+}
+
+ADDR_OPTS = {'-s', '-d'}
+PORT_OPTS = {'--sport', '--dport'}
+PORTLIST_OPTS = {'--sports', '--dports', '--ports'}
+FLAGLIST_OPTS = {'--ctstate', '--state', '--ctstatus'}
+# options whose single (quoted) value may itself start with a '-'
+TEXT_OPTS = {'--comment', '--log-prefix', '--nflog-prefix'}
+# options that say nothing about what a rule matches or does
+IGNORED_MODULES = {'comment'}
+# targets that end a packet's walk through the chain
+TERMINAL_TARGETS = {'ACCEPT', 'DROP', 'REJECT', 'RETURN'}
+# match modules that keep state across packets, so the rules using them
+# must see the same packets in the same order
+STATEFUL_MODULES = {'recent', 'limit', 'hashlimit', 'quota', 'statistic', 'connlimit', 'nth'}
+
+# options whose values vary between rules of the same shape, as in a
+# blocklist; see parse_spec_cached()
+SHAPE_OPTS = {'-s', '-d', '--source', '--src', '--destination', '--dst', '--comment'}
+SHAPE_CACHE_SIZE = 4096
+
+TOKEN_RE = re.compile(r'"((?:[^"\\]|\\.)*)"|\'([^\']*)\'|([^\s"\']+)')
+UNESCAPE = re.compile(r'\\(.)')
+# rule counters, chain counters, comments and blank lines; each starts
+# with a literal so that re can skip ahead to it
+NOISE_RES = (
+    (re.compile(r'\n\[\d+:\d+\] '), '\n'),
+    (re.compile(r' \[\d+:\d+\](?=\n)'), ''),
+    (re.compile(r'\n#[^\n]*'), ''),
+    (re.compile(r'\n\s*(?=\n)'), ''),
+)
+IPV4_RE = re.compile(r'(?:(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.){3}(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)')
+
+
+def tokenize(line):
+    """
+    Split a rule line into tokens. iptables-save only ever double-quotes
+    values (escaping quotes inside them), so a regex does the job of
+    shlex at a fraction of the cost; plain lines just split().
+
+    Returns:
+        tokens (list): the words of the line
+    """
+    if '"' not in line and "'" not in line:
+        return line.split()
+    parts = line.split('"')
+    if len(parts) == 3 and '\\' not in line and "'" not in line:
+        # the usual case: one quoted comment or log prefix
+        return parts[0].split() + [parts[1]] + parts[2].split()
+    tokens = list()
+    for (dquoted, squoted, word) in TOKEN_RE.findall(line):
+        if word:
+            tokens.append(word)
+        elif squoted:
+            tokens.append(squoted)
+        else:
+            tokens.append(UNESCAPE.sub(r'\1', dquoted))
+    return tokens
+
+
+def normalize_addr(value):
+    """
+    Normalize an address or comma list of addresses to sorted CIDRs, with
+    host bits cleared and dotted masks turned into prefix lengths.
+
+    Returns:
+        value (str): the canonical address list
+    """
+    out = list()
+    for part in value.split(','):
+        # blocklists are mostly bare or /32 IPv4 hosts, which are already
+        # canonical once they have a /32
+        (addr, _, mask) = part.partition('/')
+        if mask in ('', '32') and IPV4_RE.fullmatch(addr):
+            out.append(addr + '/32')
+            continue
+        try:
+            out.append(str(ipaddress.ip_network(part, strict=False)))
+        except ValueError:
+            # a hostname, say; leave it be
+            out.append(part.lower())
+    return ','.join(sorted(out))
+
+
+def normalize_port(value):
+    """
+    Normalize a port or port range, resolving service names.
+
+    Returns:
+        value (str): port number, or first:last
+    """
+    def number(p, default):
+        if p == '':
+            return default
+        if p.isdigit():
+            return int(p)
+        if p.lower() in SERVICES:
+            return SERVICES[p.lower()]
+        try:
+            return socket.getservbyname(p)
+        except OSError:
+            return p
+
+    if ':' in value:
+        (first, last) = value.split(':', 1)
+        (first, last) = (number(first, 0), number(last, 65535))
+        if first != last:
+            return '{0}:{1}'.format(first, last)
+        return str(first)
+    return str(number(value, value))
+
+
+def port_sort_key(value):
+    first = value.split(':')[0]
+    return (0, int(first), value) if first.isdigit() else (1, 0, value)
+
+
+def normalize_values(opt, values):
+    """
+    Normalize the values of one option.
+
+    Returns:
+        values (tuple): the canonical values
+    """
+    if not values:
+        return ()
+    if opt in ADDR_OPTS:
+        return (normalize_addr(values[0]),)
+    if opt == '-p':
+        proto = values[0].lower()
+        return (PROTO_ALIASES.get(proto, proto),)
+    if opt in PORT_OPTS:
+        return (normalize_port(values[0]),)
+    if opt in PORTLIST_OPTS:
+        return (','.join(sorted((normalize_port(p) for p in values[0].split(',')), key=port_sort_key)),)
+    if opt in FLAGLIST_OPTS:
+        return (','.join(sorted(values[0].upper().split(','))),)
+    if opt == '--tcp-flags':
+        return tuple(','.join(sorted(v.upper().split(','))) for v in values)
+    if opt in ('--icmp-type', '--icmpv6-type'):
+        return (ICMP_TYPES.get(values[0].lower(), values[0].lower()),)
+    return tuple(values)
+
+
+def split_options(tokens):
+    """
+    Group rule tokens into (negated, option, values) tuples. Negation may
+    come before the option or, in the old style, before its value.
+
+    Returns:
+        opts (list): list of (negated, option, [values])
+    """
+    def is_opt(tok):
+        return tok.startswith('-') and len(tok) > 1 and not tok[1:].isdigit()
+
+    opts = list()
+    neg = False
+    for (i, tok) in enumerate(tokens):
+        if opts and opts[-1][1] in TEXT_OPTS and not opts[-1][2]:
+            opts[-1][2].append(tok)
+        elif tok == '!':
+            nxt = tokens[i + 1] if i + 1 < len(tokens) else ''
+            if opts and not opts[-1][2] and not neg and not is_opt(nxt):
+                # old style: -s ! 1.2.3.4
+                opts[-1][0] = True
+            else:
+                neg = True
+        elif is_opt(tok):
+            opts.append([neg, OPT_ALIASES.get(tok, tok), list()])
+            neg = False
+        elif opts:
+            opts[-1][2].append(tok)
+    return opts
+
+
+def parse_spec(tokens):
+    """
+    Parse the options of a rule (everything after `-A CHAIN`) into a
+    canonical Spec. Match options that follow `-p tcp` without a `-m`
+    are put in the protocol's module, as iptables itself does, and
+    `-m state --state` is folded into `-m conntrack --ctstate`.
+
+    Returns:
+        (spec, counters): the Spec, and (packets, bytes) from -c or None
+    """
+    basic = list()
+    modules = dict()
+    target = list()
+    counters = None
+    current = None
+    proto = None
+    for (neg, opt, values) in split_options(tokens):
+        if opt == '-m':
+            current = values[0].lower() if values else ''
+            if current == 'state':
+                current = 'conntrack'
+            modules.setdefault(current, list())
+            continue
+        if opt in ('-j', '-g'):
+            current = target
+            target.append((neg, opt, tuple(values)))
+            continue
+        if opt == '-c' and current is not target:
+            counters = tuple(int(v) for v in values[:2]) if len(values) == 2 else None
+            continue
+        if current is target:
+            target.append((neg, opt, tuple(values)))
+            continue
+        if current is not target and opt in BASIC_OPTS:
+            values = normalize_values(opt, values)
+            if opt == '-p':
+                proto = values[0] if values else None
+            basic.append((neg, opt, values))
+            continue
+        if opt == '--state':
+            opt = '--ctstate'
+        module = current if current is not None else (proto or '')
+        modules.setdefault(module, list()).append((neg, opt, normalize_values(opt, values)))
+    # -p tcp -m tcp with no tcp options says no more than -p tcp
+    for name in [m for m in modules if not modules[m] and m == proto]:
+        del modules[name]
+    for name in IGNORED_MODULES:
+        modules.pop(name, None)
+    spec = Spec(tuple(sorted(basic)),
+                tuple(sorted((m, tuple(sorted(o))) for (m, o) in modules.items())),
+                tuple(target[:1]) + tuple(sorted(target[1:])))
+    return (spec, counters)
+
+
+def parse_spec_cached(tokens, cache):
+    """
+    parse_spec(), cached on the shape of the rule: its tokens with the
+    addresses and comment blanked out. Rules of a blocklist differ only
+    in those, so they are parsed once and each then only has its
+    addresses normalized into the cached Spec and key. Once the cache
+    holds SHAPE_CACHE_SIZE shapes, new ones are parsed as they are.
+
+    Returns:
+        (spec, counters, key): as parse_spec(), plus spec_key(spec)
+    """
+    shape = list(tokens)
+    addrs = dict()
+    for i in range(1, len(tokens)):
+        if tokens[i - 1] in SHAPE_OPTS and tokens[i] != '!':
+            if tokens[i - 1] == '--comment':
+                shape[i] = ''
+            else:
+                shape[i] = '%%addr{0}%%'.format(len(addrs))
+                addrs[shape[i]] = tokens[i]
+    shape = tuple(shape)
+    hit = cache.get(shape)
+    if hit is None and len(cache) < SHAPE_CACHE_SIZE and '-c' not in tokens and '--set-counters' not in tokens:
+        hit = parse_spec(shape)
+        # only shapes whose blanks all land in -s/-d can be reused; the
+        # others are remembered as such, so they are not parsed again
+        found = set(v[0] for (_, o, v) in hit[0].basic if o in ADDR_OPTS and v)
+        hit = hit + (spec_key(hit[0]),) if found.issuperset(addrs) else False
+        cache[shape] = hit
+    if not hit:
+        # a full cache, counters or an unusable shape: one plain parse
+        (spec, counters) = parse_spec(tokens)
+        return (spec, counters, spec_key(spec))
+    (spec, counters, key) = hit
+    if addrs:
+        addrs = dict((ph, normalize_addr(a)) for (ph, a) in addrs.items())
+        spec = spec._replace(basic=tuple((neg, opt, (addrs[v[0]],) if v and v[0] in addrs else v)
+                                         for (neg, opt, v) in spec.basic))
+        for (ph, a) in addrs.items():
+            key = key.replace(ph, a)
+    return (spec, counters, key)
+
+
+def format_opts(opts):
+    out = list()
+    for (neg, opt, values) in opts:
+        if neg:
+            out.append('!')
+        out.append(opt)
+        out.extend(shlex.quote(v) for v in values)
+    return out
+
+
+def spec_key(spec):
+    """
+    Render a Spec as its canonical rule text, which is also its hash key.
+
+    Returns:
+        key (str): e.g. "-p tcp -m tcp --dport 22 -j ACCEPT"
+    """
+    out = format_opts(spec.basic)
+    for (module, opts) in spec.modules:
+        out.extend(['-m', module])
+        out.extend(format_opts(opts))
+    out.extend(format_opts(spec.target))
+    return ' '.join(out)
+
+
+def parse_ports(value):
+    """
+    Returns:
+        ranges (list): (first, last) for each port or range in a
+            normalized port list, or None if a name did not resolve
+    """
+    ranges = list()
+    for part in value.split(','):
+        (first, _, last) = part.partition(':')
+        if not first.isdigit() or (last and not last.isdigit()):
+            return None
+        ranges.append((int(first), int(last or first)))
+    return ranges
+
+
+def match_space(spec):
+    """
+    Work out the part of the packet space a rule's Spec matches.
+
+    Returns:
+        Match
+    """
+    fields = dict.fromkeys(Match._fields)
+    extra = list()
+    for (neg, opt, values) in spec.basic:
+        if neg or not values:
+            if opt != '-c':
+                extra.append(('', (neg, opt, values)))
+            continue
+        if opt == '-p':
+            fields['proto'] = values[0]
+        elif opt in ADDR_OPTS:
+            try:
+                nets = [ipaddress.ip_network(v) for v in values[0].split(',')]
+            except ValueError:
+                extra.append(('', (neg, opt, values)))
+                continue
+            fields['src' if opt == '-s' else 'dst'] = nets
+        elif opt in ('-i', '-o'):
+            fields['iface_in' if opt == '-i' else 'iface_out'] = values[0]
+        else:
+            extra.append(('', (neg, opt, values)))
+    for (module, opts) in spec.modules:
+        for o in opts:
+            (neg, opt, values) = o
+            field = {'--dport': 'dports', '--dports': 'dports', '--sport': 'sports', '--sports': 'sports'}.get(opt)
+            if field and not neg and values and parse_ports(values[0]) is not None:
+                fields[field] = parse_ports(values[0])
+            elif module == 'conntrack' and opt == '--ctstate' and not neg and values:
+                fields['ctstate'] = frozenset(values[0].split(','))
+            else:
+                extra.append((module, o))
+    fields['extra'] = frozenset(extra)
+    return Match(**fields)
+
+
+def nets_overlap(a, b):
+    return any(x.version == y.version and x.overlaps(y) for x in a for y in b)
+
+
+def ranges_overlap(a, b):
+    return any(x[0] <= y[1] and y[0] <= x[1] for x in a for y in b)
+
+
+def iface_overlap(a, b):
+    # iptables interface names may end in a + wildcard
+    if a.endswith('+') or b.endswith('+'):
+        return a.rstrip('+').startswith(b.rstrip('+')) or b.rstrip('+').startswith(a.rstrip('+'))
+    return a == b
+
+
+def disjoint(a, b, basic_only=False):
+    """
+    Tell whether two Matches can be shown never to match the same packet.
+    Anything not modelled is assumed to overlap. With basic_only, only
+    the fields the kernel checks before any match module count.
+
+    Returns:
+        bool: True if no packet can match both
+    """
+    if a.proto and b.proto and a.proto != b.proto:
+        return True
+    checks = [(a.src, b.src, nets_overlap), (a.dst, b.dst, nets_overlap),
+              (a.iface_in, b.iface_in, iface_overlap), (a.iface_out, b.iface_out, iface_overlap)]
+    if not basic_only:
+        checks.extend([(a.sports, b.sports, ranges_overlap), (a.dports, b.dports, ranges_overlap)])
+    for (x, y, overlap) in checks:
+        if x is not None and y is not None and not overlap(x, y):
+            return True
+    if not basic_only and a.ctstate is not None and b.ctstate is not None and not (a.ctstate & b.ctstate):
+        return True
+    return False
+
+
+def ranges_cover(a, b):
+    return all(any(x[0] <= y[0] and y[1] <= x[1] for x in a) for y in b)
+
+
+def covers(a, b):
+    """
+    Tell whether Match a matches every packet Match b does. Anything a
+    checks that is not modelled must be checked by b too.
+
+    Returns:
+        bool
+    """
+    if a.proto is not None and a.proto != b.proto:
+        return False
+    for (x, y) in ((a.src, b.src), (a.dst, b.dst)):
+        if x is not None and (y is None or not all(any(n.version == m.version and n.subnet_of(m) for m in x) for n in y)):
+            return False
+    for (x, y) in ((a.iface_in, b.iface_in), (a.iface_out, b.iface_out)):
+        if x is not None and (y is None or not (x == y or (x.endswith('+') and y.rstrip('+').startswith(x.rstrip('+'))))):
+            return False
+    for (x, y) in ((a.sports, b.sports), (a.dports, b.dports)):
+        if x is not None and (y is None or not ranges_cover(x, y)):
+            return False
+    if a.ctstate is not None and (b.ctstate is None or not b.ctstate <= a.ctstate):
+        return False
+    return a.extra <= b.extra
+
+
+def rule_target(rule):
+    """
+    Returns:
+        (option, target, has_options): e.g. ('-j', 'ACCEPT', False), or
+            (None, None, False) for a rule without a target
+    """
+    if not rule.spec.target:
+        return (None, None, False)
+    (_, opt, values) = rule.spec.target[0]
+    return (opt, values[0] if values else None, len(rule.spec.target) > 1)
+
+
+def is_terminal(rule):
+    (opt, target, _) = rule_target(rule)
+    return opt == '-g' or target in TERMINAL_TARGETS
+
+
+def is_stateful(rule):
+    return any(m in STATEFUL_MODULES for (m, _) in rule.spec.modules)
+
+
+class Ruleset:
+    """
+    The canonical form of an `iptables-save` dump: chain policies and the
+    ordered rules of every chain, keyed by (table, chain).
+    """
+
+    def __init__(self):
+        self.policies = dict()
+        self.policy_counters = dict()
+        self.rules = dict()
+        self._counts = None
+
+    @classmethod
+    def parse(cls, lines):
+        """
+        Parse iptables-save output (with or without -c counters).
+
+        Returns:
+            Ruleset
+        """
+        rs = cls()
+        table = None
+        cache = dict()
+        for (lineno, line) in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#') or line == 'COMMIT':
+                continue
+            if line.startswith('*'):
+                table = line[1:]
+                continue
+            if table is None:
+                raise ValueError("line {0}: rule outside of a table: {1}".format(lineno, line))
+            if line.startswith(':'):
+                # :INPUT ACCEPT [0:0]
+                fields = line[1:].split()
+                rs.policies[(table, fields[0])] = fields[1] if len(fields) > 1 else '-'
+                rs.rules.setdefault((table, fields[0]), list())
+                if len(fields) > 2 and fields[2].startswith('['):
+                    (packets, _, nbytes) = fields[2].strip('[]').partition(':')
+                    rs.policy_counters[(table, fields[0])] = (int(packets), int(nbytes))
+                continue
+            (packets, nbytes) = (None, None)
+            if line.startswith('['):
+                (counters, _, line) = line.partition(' ')
+                (packets, _, nbytes) = counters.strip('[]').partition(':')
+                (packets, nbytes) = (int(packets), int(nbytes))
+            tokens = tokenize(line)
+            if len(tokens) < 2 or tokens[0] not in ('-A', '--append'):
+                raise ValueError("line {0}: not an -A rule: {1}".format(lineno, line))
+            chain = tokens[1]
+            (spec, counters, key) = parse_spec_cached(tokens[2:], cache)
+            if counters:
+                (packets, nbytes) = counters
+            rs.rules.setdefault((table, chain), list()).append(
+                Rule(table, chain, key, line, packets, nbytes, spec))
+        return rs
+
+    def counts(self):
+        """
+        Returns:
+            counts (dict): (table, chain) -> Counter of rule keys
+        """
+        if self._counts is None:
+            self._counts = dict((tc, Counter(r.key for r in rules)) for (tc, rules) in self.rules.items())
+        return self._counts
+
+
+def multiset_diff(rules, have):
+    """
+    Pick out the rules whose keys are not covered by the counts in have,
+    allowing for duplicates, in their original order.
+
+    Returns:
+        rules (list): the rules that are left over
+    """
+    left = Counter(have)
+    out = list()
+    for r in rules:
+        if left[r.key] > 0:
+            left[r.key] -= 1
+        else:
+            out.append(r)
+    return out
+
+
+def diff_rulesets(template, local):
+    """
+    Diff two Rulesets chain by chain.
+
+    Returns:
+        diffs (list): ChainDiff for every chain that differs
+    """
+    diffs = list()
+    tcounts = template.counts()
+    lcounts = local.counts()
+    for tc in sorted(set(template.rules) | set(local.rules)):
+        tpol = template.policies.get(tc)
+        lpol = local.policies.get(tc)
+        policy = (tpol, lpol) if tpol != lpol else None
+        missing = multiset_diff(template.rules.get(tc, []), lcounts.get(tc, Counter()))
+        extra = multiset_diff(local.rules.get(tc, []), tcounts.get(tc, Counter()))
+        if policy or missing or extra:
+            diffs.append(ChainDiff(tc[0], tc[1], policy, missing, extra))
+    return diffs
+
+
+def diff_to_json(diffs):
+    """
+    Returns:
+        list: the diffs as plain dicts, for json.dumps
+    """
+    return [{
+        'table': d.table,
+        'chain': d.chain,
+        'policy': {'template': d.policy[0], 'local': d.policy[1]} if d.policy else None,
+        'missing': [r.text for r in d.missing],
+        'extra': [r.text for r in d.extra],
+    } for d in diffs]
+
+
+def print_diffs(diffs, verbose=False):
+    """
+    Print the differences for each chain, diff style: + for rules in the
+    template but not the local rules, - for local rules not in the template.
+    """
+    for d in diffs:
+        print("*{0} {1}".format(d.table, d.chain))
+        if d.policy:
+            print("  policy: template {0}, local {1}".format(d.policy[0] or '(no chain)', d.policy[1] or '(no chain)'))
+        for r in d.missing:
+            print("+ " + r.text)
+            if verbose:
+                print("    key: " + r.key)
+        for r in d.extra:
+            print("- " + r.text)
+            if verbose:
+                print("    key: " + r.key)
+
+
+def render_ruleset(rs, rules=None):
+    """
+    Render a Ruleset back into iptables-save format, without counters,
+    optionally with some chains' rules replaced.
+
+    Args:
+        rs: the Ruleset
+        rules: (table, chain) -> list of Rule to use instead
+
+    Returns:
+        text (str): input for a full iptables-restore
+    """
+    rules = rules or dict()
+    out = list()
+    tables = list(dict.fromkeys(t for (t, _) in rs.rules))
+    for table in tables:
+        chains = [c for (t, c) in rs.rules if t == table]
+        out.append('*' + table)
+        for chain in chains:
+            out.append(":{0} {1} [0:0]".format(chain, rs.policies.get((table, chain), '-')))
+        for chain in chains:
+            for r in rules.get((table, chain), rs.rules[(table, chain)]):
+                out.append("-A {0} {1}".format(chain, rule_body(r)).rstrip())
+        out.append('COMMIT')
+    return '\n'.join(out) + '\n'
+
+
+def chain_evaluations(rules, fallthrough=0):
+    """
+    Estimate the rule evaluations a chain costs: each packet a terminal
+    rule matched was checked against every rule up to it, and each
+    packet that fell through to the policy against all of them.
+
+    Returns:
+        evaluations (int)
+    """
+    total = fallthrough * len(rules)
+    for (pos, r) in enumerate(rules, 1):
+        if r.packets and is_terminal(r):
+            total += r.packets * pos
+    return total
+
+
+def can_pass(hot, cold):
+    """
+    Tell whether a rule can be moved ahead of the rule before it without
+    changing what happens to any packet: the two match disjoint packets,
+    or they are terminal with the same plain verdict. A rule with a
+    stateful match (limit, recent, ...) must keep seeing the same
+    packets, so it can only be passed by a rule that the basic matches,
+    which the kernel checks before any module, keep apart from it.
+
+    Returns:
+        bool
+    """
+    (a, b) = (match_space(hot.spec), match_space(cold.spec))
+    if is_stateful(hot) or is_stateful(cold):
+        return disjoint(a, b, basic_only=True)
+    if rule_target(hot) == rule_target(cold) and is_terminal(hot) and not rule_target(hot)[2]:
+        return True
+    return disjoint(a, b)
+
+
+def reorder_chain(rules, hot_share=0.01):
+    """
+    Move hot rules, hottest first, up past the colder rules before them,
+    as far as can_pass() allows. Only rules with at least hot_share of
+    the chain's packets are moved, which keeps the overlap checks to a
+    few passes over the chain.
+
+    Returns:
+        (order, moves): the new order, and (rule, old, new) 1-based
+            positions for each rule moved
+    """
+    total = sum(r.packets or 0 for r in rules)
+    if not total:
+        return (list(rules), list())
+    hot = sorted((r for r in rules if r.packets and r.packets >= total * hot_share),
+                 key=lambda r: -r.packets)
+    order = list(rules)
+    moves = list()
+    for h in hot:
+        i = next(n for (n, r) in enumerate(order) if r is h)
+        j = i
+        while j > 0 and (order[j - 1].packets or 0) < h.packets and can_pass(h, order[j - 1]):
+            j -= 1
+        if j < i:
+            order.insert(j, order.pop(i))
+            moves.append((h, rules.index(h) + 1, j + 1))
+    return (order, moves)
+
+
+def reorder_report(rs, hot_share=0.01):
+    """
+    Reorder every chain of a Ruleset that has counters.
+
+    Returns:
+        (report, rules): a list of per-chain dicts with the moves and the
+            rule evaluations before and after, and (table, chain) -> the
+            reordered rules, for render_ruleset()
+    """
+    report = list()
+    reordered = dict()
+    for (tc, rules) in rs.rules.items():
+        (order, moves) = reorder_chain(rules, hot_share)
+        if not moves:
+            continue
+        fallthrough = rs.policy_counters.get(tc, (0, 0))[0]
+        before = chain_evaluations(rules, fallthrough)
+        after = chain_evaluations(order, fallthrough)
+        reordered[tc] = order
+        report.append({
+            'table': tc[0],
+            'chain': tc[1],
+            'evaluations_before': before,
+            'evaluations_after': after,
+            'reduction': round(1 - after / before, 4) if before else 0.0,
+            'moves': [{'rule': r.text, 'packets': r.packets, 'from': old, 'to': new} for (r, old, new) in moves],
+        })
+    return (report, reordered)
+
+
+def exact_file(node, value):
+    return [node.setdefault(value, dict())]
+
+
+def exact_probe(node, value):
+    return [node[value]] if value in node else list()
+
+
+def prefix_file(node, nets):
+    # under (version, prefix length), then the network bits
+    return [node.setdefault((n.version, n.prefixlen), dict()).setdefault(int(n.network_address) >> (n.max_prefixlen - n.prefixlen), dict())
+            for n in nets]
+
+
+def prefix_probe(node, nets):
+    # the prefixes containing the first net, radix style, for the prefix
+    # lengths present: a rule covering all of the nets has one of these
+    found = list()
+    if nets is not None:
+        n = nets[0]
+        addr = int(n.network_address)
+        for ((version, length), bits) in node.items():
+            if version == n.version and length <= n.prefixlen:
+                child = bits.get(addr >> (n.max_prefixlen - length))
+                if child is not None:
+                    found.append(child)
+    return found
+
+
+def port_blocks(ranges):
+    # each port range under the smallest aligned power-of-two block that
+    # holds it, so port ranges index like prefixes of a 16-bit address;
+    # a range is first split where the block halves, so no block is more
+    # than about twice the range it holds
+    blocks = set()
+    for (first, last) in ranges:
+        if first > last:
+            blocks.add((0, 0))
+            continue
+        half = (first ^ last).bit_length() - 1
+        middle = last >> half << half if half >= 0 else first
+        for (x, y) in ((first, middle - 1), (middle, last)):
+            if x <= y:
+                bits = (x ^ y).bit_length()
+                blocks.add((16 - bits, x >> bits))
+    return blocks
+
+
+def port_file(node, ranges):
+    return [node.setdefault(k, dict()).setdefault(bits, dict()) for (k, bits) in port_blocks(ranges)]
+
+
+def port_probe(node, ranges):
+    found = list()
+    if ranges is not None:
+        (port, last) = ranges[0]
+        for (k, bits) in node.items():
+            if port > last:
+                found.extend(bits.values())
+                continue
+            child = bits.get(port >> (16 - k))
+            if child is not None:
+                found.append(child)
+    return found
+
+
+def iface_probe(node, value):
+    # the name itself, or any + wildcard it falls under
+    found = exact_probe(node, value)
+    if value is not None:
+        stem = value.rstrip('+')
+        found.extend(node[stem[:k] + '+'] for k in range(len(stem) + 1) if stem[:k] + '+' in node and stem[:k] + '+' != value)
+    return found
+
+
+def ctstate_probe(node, value):
+    # few distinct state sets ever appear, so just test them all
+    if value is None:
+        return list()
+    return [child for (k, child) in node.items() if value <= k]
+
+
+def extra_probe(node, value):
+    # the unmodelled matches of the covering rule are a subset of ours:
+    # try each subset, or each key if there are fewer of those
+    if len(node) <= 1 << len(value):
+        return [child for (k, child) in node.items() if k <= value]
+    subsets = (frozenset(c) for n in range(1, len(value) + 1) for c in itertools.combinations(value, n))
+    return [node[k] for k in subsets if k in node]
+
+
+# the fields a CoverIndex is keyed on, the usually most selective first:
+# (Match field, how a rule is filed under a node, how to find the
+# children that may hold a rule covering a value)
+COVER_DIMS = (
+    ('src', prefix_file, prefix_probe),
+    ('dst', prefix_file, prefix_probe),
+    ('dports', port_file, port_probe),
+    ('sports', port_file, port_probe),
+    ('proto', exact_file, exact_probe),
+    ('iface_in', exact_file, iface_probe),
+    ('iface_out', exact_file, iface_probe),
+    ('ctstate', exact_file, ctstate_probe),
+    ('extra', exact_file, extra_probe),
+)
+
+
+class CoverIndex:
+    """
+    Index of the terminal rules seen so far in a chain, to find an earlier
+    rule that covers a later one without comparing every pair. It is a
+    sparse trie over the modelled fields (COVER_DIMS): a rule is filed
+    under each field it checks, in turn, by address prefix, by the
+    power-of-two blocks its port ranges fall in, or by value. A lookup
+    only follows the children that could hold a rule covering the later
+    one, and only tries the prefix lengths present, so it does not walk
+    anything that grows with the chain; the rules it reaches are then
+    checked with covers().
+    """
+
+    def __init__(self):
+        # node: {level: {key: node}, None: [(pos, rule, match)]}
+        self.root = dict()
+
+    def add(self, pos, rule, match):
+        nodes = [self.root]
+        for (level, (field, file, _)) in enumerate(COVER_DIMS):
+            value = getattr(match, field)
+            if value:
+                nodes = [child for node in nodes for child in file(node.setdefault(level, dict()), value)]
+        for node in nodes:
+            node.setdefault(None, list()).append((pos, rule, match))
+
+    def find(self, match):
+        """
+        Returns:
+            (pos, rule): the earliest indexed rule covering match, or None
+        """
+        best = None
+        todo = [self.root]
+        while todo:
+            node = todo.pop()
+            for (level, children) in node.items():
+                if level is None:
+                    for (pos, rule, m) in children:
+                        if best is not None and pos >= best[0]:
+                            break
+                        if covers(m, match):
+                            best = (pos, rule)
+                            break
+                else:
+                    (field, _, probe) = COVER_DIMS[level]
+                    todo.extend(probe(children, getattr(match, field)))
+        return best
+
+
+def find_shadowed(rules):
+    """
+    Find the rules in a chain that can never match, because an earlier
+    terminal rule matches all of their packets, and identical repeats of
+    earlier rules.
+
+    Returns:
+        findings (list): (pos, rule, kind, by_pos, by_rule), 1-based, where
+            kind is 'duplicate' (same rule), 'redundant' (same verdict) or
+            'shadowed' (a different verdict; likely a mistake). Only dead
+            rules have a by_rule that is terminal and not stateful.
+    """
+    index = CoverIndex()
+    seen = dict()
+    findings = list()
+    for (pos, rule) in enumerate(rules, 1):
+        match = match_space(rule.spec)
+        hit = index.find(match)
+        if hit:
+            (by_pos, by_rule) = hit
+            if by_rule.key == rule.key:
+                kind = 'duplicate'
+            elif rule_target(by_rule) == rule_target(rule):
+                kind = 'redundant'
+            else:
+                kind = 'shadowed'
+            findings.append((pos, rule, kind, by_pos, by_rule))
+            continue
+        if rule.key in seen:
+            findings.append((pos, rule, 'duplicate', seen[rule.key], rules[seen[rule.key] - 1]))
+        else:
+            seen[rule.key] = pos
+        if is_terminal(rule) and not is_stateful(rule):
+            index.add(pos, rule, match)
+    return findings
+
+
+def shadow_report(rs):
+    """
+    Run find_shadowed() over every chain of a Ruleset.
+
+    Returns:
+        (report, rules): a list of per-chain dicts of findings, and
+            (table, chain) -> the rules left once the dead ones are
+            pruned, for render_ruleset()
+    """
+    report = list()
+    pruned = dict()
+    for (tc, rules) in rs.rules.items():
+        findings = find_shadowed(rules)
+        if not findings:
+            continue
+        # only rules behind a terminal rule are dead; a repeated LOG or
+        # jump still runs twice, so it is reported but kept
+        # nor is a stateful rule: each copy of a limit or statistic rule
+        # keeps its own state, so removing one changes what the rest do
+        dead = set(pos for (pos, r, _, _, by) in findings
+                   if is_terminal(by) and not is_stateful(by) and not is_stateful(r))
+        pruned[tc] = [r for (pos, r) in enumerate(rules, 1) if pos not in dead]
+        report.append({
+            'table': tc[0],
+            'chain': tc[1],
+            'rules': len(rules),
+            'pruned': len(dead),
+            'findings': [{'pos': pos, 'rule': r.text, 'kind': kind, 'by_pos': by_pos, 'by_rule': by.text, 'pruned': pos in dead}
+                         for (pos, r, kind, by_pos, by) in findings],
+        })
+    return (report, pruned)
+
+
+def rule_body(rule):
+    """
+    Returns:
+        body (str): the rule's text without its leading `-A CHAIN`
+    """
+    return rule.text.split(None, 2)[2] if len(rule.text.split(None, 2)) > 2 else ''
+
+
+def plan_inserts(template_rules, local_rules):
+    """
+    Work out where each template rule missing from a local chain goes.
+    Walking the template chain in order, every rule the local chain has
+    moves the insertion point to just after it, so missing rules land
+    after the rules that precede them in the template rather than at
+    the end of the chain.
+
+    Returns:
+        inserts (list): (1-based position, rule) in the order to insert
+    """
+    positions = defaultdict(deque)
+    for (i, r) in enumerate(local_rules):
+        positions[r.key].append(i)
+    inserts = list()
+    anchor = 0
+    for r in template_rules:
+        if positions[r.key]:
+            anchor = max(anchor, positions[r.key].popleft() + 1)
+        else:
+            inserts.append((anchor + len(inserts) + 1, r))
+    return inserts
+
+
+def render_restore(template, local):
+    """
+    Render the changes that bring the local rules up to the template as
+    one `iptables-restore --noflush` file, a section per table. Chains
+    the local rules lack are created, built-in chain policies are set
+    where they differ, and missing rules are inserted with -I; nothing
+    is deleted. Existing user chains are not declared, as --noflush
+    would flush them.
+
+    Returns:
+        text (str): the restore file, empty if there is nothing to do
+    """
+    out = list()
+    tables = sorted(set(t for (t, _) in template.rules))
+    for table in tables:
+        chains = [c for (t, c) in template.rules if t == table]
+        decls = list()
+        rules = list()
+        for chain in chains:
+            tc = (table, chain)
+            tpol = template.policies.get(tc, '-')
+            if tc not in local.policies:
+                decls.append(":{0} {1} [0:0]".format(chain, tpol))
+            elif tpol != '-' and tpol != local.policies[tc]:
+                decls.append(":{0} {1} [0:0]".format(chain, tpol))
+            for (pos, r) in plan_inserts(template.rules[tc], local.rules.get(tc, [])):
+                rules.append("-I {0} {1} {2}".format(chain, pos, rule_body(r)).rstrip())
+        if decls or rules:
+            out.append('*' + table)
+            out.extend(decls)
+            out.extend(rules)
+            out.append('COMMIT')
+    return '\n'.join(out) + '\n' if out else ''
+
+
+def apply_restore(text, ipv6=False, test=False):
+    """
+    Load a restore file with a single `iptables-restore --noflush` run.
+    Each table is committed to the kernel in one go, or not at all.
+    """
+    cmd = ['ip6tables-restore' if ipv6 else 'iptables-restore', '--noflush']
+    if test:
+        cmd.append('--test')
+    subprocess.run(cmd, input=text, text=True, check=True)
+
+
+def ruleset_digest(text):
+    """
+    Hash a dump with its comments, counters and blank lines left out, so
+    that two dumps of the same rules hash the same whenever they were
+    taken. A few regex passes over the whole text keep this cheap next
+    to parsing it.
+
+    Returns:
+        digest (str): hex SHA-1 of the significant text
+    """
+    text = '\n' + text.replace('\r', '') + '\n'
+    for (regex, repl) in NOISE_RES:
+        text = regex.sub(repl, text)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+# the template, parsed once per worker process by init_worker()
+_template = None
+
+
+def init_worker(template):
+    global _template
+    _template = template
+
+
+def digest_dump(path):
+    """
+    Returns:
+        (digest, error): ruleset_digest() of the dump at path, or the
+            reason it could not be read
+    """
+    try:
+        with open(path, 'r') as f:
+            return (ruleset_digest(f.read()), None)
+    except (OSError, UnicodeDecodeError) as err:
+        return (None, str(err))
+
+
+def diff_dump(path):
+    """
+    Diff the dump at path against the worker's template.
+
+    Returns:
+        dict: 'diffs' as diff_to_json(), or 'error'
+    """
+    try:
+        with open(path, 'r') as f:
+            return {'diffs': diff_to_json(diff_rulesets(_template, Ruleset.parse(f)))}
+    except (OSError, UnicodeDecodeError, ValueError) as err:
+        return {'error': str(err)}
+
+
+def fleet_report(template, template_path, dump_dir, processes=None):
+    """
+    Check every iptables-save dump in dump_dir against the template.
+    The workers of a process pool, each handed the parsed template once,
+    first hash every dump with ruleset_digest(), then parse and diff one
+    dump per distinct digest, so hosts cloned from one image cost a
+    single parse.
+
+    Returns:
+        report (dict): the drift report, with the hosts in sync, the
+            drifted hosts and their ruleset digest, the diffs for each
+            drifted ruleset, and any dumps that could not be read
+    """
+    names = sorted(n for n in os.listdir(dump_dir) if os.path.isfile(os.path.join(dump_dir, n)))
+    hosts = dict()
+    paths = dict()
+    errors = dict()
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker, initargs=(template,)) as pool:
+        for (name, (digest, error)) in zip(names, pool.map(digest_dump, (os.path.join(dump_dir, n) for n in names), chunksize=8)):
+            if error:
+                errors[name] = error
+                continue
+            hosts[name] = digest
+            paths.setdefault(digest, os.path.join(dump_dir, name))
+        digests = list(paths)
+        results = dict(zip(digests, pool.map(diff_dump, (paths[d] for d in digests))))
+
+    report = {
+        'template': template_path,
+        'generated': int(time.time()),
+        'hosts': len(hosts),
+        'unique_rulesets': len(digests),
+        'in_sync': list(),
+        'drifted': dict(),
+        'rulesets': dict(),
+        'errors': errors,
+    }
+    for (name, digest) in hosts.items():
+        result = results[digest]
+        if 'error' in result:
+            errors[name] = result['error']
+        elif result['diffs']:
+            report['drifted'][name] = digest
+            report['rulesets'].setdefault(digest, {'hosts': list(), 'diffs': result['diffs']})['hosts'].append(name)
+        else:
+            report['in_sync'].append(name)
+    return report
+
+
+def print_reorder(report, verbose=False):
+    """
+    Print the hot rules moved in each chain and the evaluations saved.
+    """
+    if not report:
+        print("No hot rules can be moved up safely.")
+    for c in report:
+        print("*{0} {1}: {2} -> {3} rule evaluations ({4:.1%} fewer)".format(
+            c['table'], c['chain'], c['evaluations_before'], c['evaluations_after'], c['reduction']))
+        for m in c['moves']:
+            print("  {0} -> {1}: {2}".format(m['from'], m['to'], m['rule']))
+            if verbose:
+                print("    packets: {0}".format(m['packets']))
+
+
+def print_shadowed(report, verbose=False):
+    """
+    Print the dead and duplicate rules found in each chain.
+    """
+    if not report:
+        print("No shadowed, redundant or duplicate rules found.")
+    for c in report:
+        print("*{0} {1}: {2} of {3} rules can be pruned".format(c['table'], c['chain'], c['pruned'], c['rules']))
+        for f in c['findings']:
+            print("  {0} {1} by {2}: {3}".format(f['pos'], f['kind'], f['by_pos'], f['rule']))
+            if verbose:
+                print("    by: " + f['by_rule'])
+
+
+def read_local_text(path=None, ipv6=False, counters=False):
+    """
+    Read the local rules from a saved dump, or from iptables-save.
+
+    Returns:
+        text (str): the dump
+    """
+    if path:
+        with open(path, 'r') as f:
+            return f.read()
+    cmd = ['ip6tables-save' if ipv6 else 'iptables-save']
+    if counters:
+        cmd.append('-c')
+    return subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+
+
+def read_local(path=None, ipv6=False, counters=False):
+    """
+    Returns:
+        lines (list): the local dump from read_local_text(), one line per entry
+    """
+    return read_local_text(path, ipv6, counters).splitlines()
+
+
+def check_rules(template, local, args):
+    """
+    Diff the local rules against the template, print the differences, and
+    write or apply the missing rules if asked to.
+
+    Returns:
+        diffs (list): the ChainDiffs found
+    """
+    # check what is in the template but not in the local rules, and the
+    # other way around, then print differences for each rule set
+    diffs = diff_rulesets(template, local)
+    if args.json:
+        print(json.dumps(diff_to_json(diffs), indent=2))
+    elif not args.quiet:
+        print_diffs(diffs, args.verbose or args.debug)
 
-def main():
-    # read in the template
-    # read the output from `iptables-save`
-    # check what is in the template, but not in the local rules
-    # check what is in the local rules, but not in the template
-    # print differences for each rule set
     # optionally, write missing rules from the template to the local rules
-    pass
+    if args.apply or args.restorefile:
+        restore = render_restore(template, local)
+        if args.debug:
+            print("DEBUG: restore file:")
+            print(restore)
+        if args.restorefile:
+            with open(args.restorefile, 'w') as out:
+                out.write(restore)
+        if args.apply and restore:
+            if os.geteuid() != 0:
+                print("ERROR: --apply must be run as root.", file=sys.stderr)
+                sys.exit(2)
+            apply_restore(restore, args.ipv6, args.test)
+    return diffs
+
+
+def watch(args):
+    """
+    Poll the local rules every --watch seconds and diff them against the
+    template whenever they change. Each poll is one iptables-save run and
+    one ruleset_digest() of its output: the full parse and diff only
+    happen when the digest differs from the last poll's, and a local
+    digest equal to the template's means the rules are in sync without
+    parsing them at all. The parsed template is kept between polls, and
+    only parsed again if the file's mtime changes.
+
+    Runs until interrupted; errors are reported and the poll retried.
+    """
+    template = None
+    template_mtime = None
+    template_digest = None
+    last = None
+    while True:
+        start = time.monotonic()
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S')
+        try:
+            mtime = os.stat(args.template).st_mtime_ns
+            if mtime != template_mtime:
+                with open(args.template, 'r') as f:
+                    text = f.read()
+                template = Ruleset.parse(text.splitlines())
+                template_digest = ruleset_digest(text)
+                template_mtime = mtime
+                # a new template means the local rules need checking again
+                last = None
+                if args.debug:
+                    print("DEBUG: {0} loaded template {1}".format(stamp, args.template))
+            text = read_local_text(args.local, args.ipv6)
+            digest = ruleset_digest(text)
+            if digest != last:
+                if digest == template_digest:
+                    if not args.quiet:
+                        print("{0} rules match the template".format(stamp))
+                else:
+                    if not args.quiet:
+                        print("{0} rules changed, checking".format(stamp))
+                    check_rules(template, Ruleset.parse(text.splitlines()), args)
+                sys.stdout.flush()
+                last = digest
+        except (OSError, ValueError, subprocess.CalledProcessError) as err:
+            print("ERROR: {0} {1}".format(stamp, err), file=sys.stderr)
+        time.sleep(max(0, args.watch - (time.monotonic() - start)))
+
+
+def main():
+    # pretty printing for objects
+    pp = pprint.PrettyPrinter(indent=4)
+
+    parser = argparse.ArgumentParser(description="Compare the local iptables rules against a template.")
+    vqd = parser.add_mutually_exclusive_group()
+    vqd.add_argument('-v', '--verbose', dest="verbose", required=False, action="store_true", help="Increase output verbosity.")
+    vqd.add_argument('-q', '--quiet', dest="quiet", required=False, action="store_true", help="Only set the exit status: 0 if the rules match, 1 if not.")
+    vqd.add_argument('--debug', dest="debug", required=False, action="store_true", help="Enable debug output.")
+    parser.add_argument('-t', '--template', dest="template", required=False, help="Template rules, in iptables-save format.")
+    where = parser.add_mutually_exclusive_group()
+    where.add_argument('-l', '--local', dest="local", required=False, help="Read the local rules from this iptables-save dump instead of running iptables-save.")
+    where.add_argument('-D', '--dump-dir', dest="dumpdir", required=False, help="Check every iptables-save dump in this directory (one per host) and print a JSON drift report.")
+    parser.add_argument('-J', '--processes', dest="processes", required=False, type=int, default=None, help="Worker processes for --dump-dir (default: one per CPU).")
+    parser.add_argument('-6', '--ipv6', dest="ipv6", required=False, action="store_true", help="Use ip6tables-save for the local rules.")
+    parser.add_argument('-j', '--json', dest="json", required=False, action="store_true", help="Print the differences as JSON.")
+    parser.add_argument('-a', '--apply', dest="apply", required=False, action="store_true", help="Add the rules missing from the local rules, in one atomic iptables-restore --noflush run.")
+    parser.add_argument('-o', '--restore-file', dest="restorefile", required=False, help="Write the iptables-restore input for the missing rules to this file.")
+    parser.add_argument('--test', dest="test", required=False, action="store_true", help="With --apply, only check the changes with iptables-restore --test.")
+    parser.add_argument('-w', '--watch', dest="watch", required=False, type=float, default=None, help="Keep running, checking the local rules every WATCH seconds, and report whenever they change.")
+    parser.add_argument('-r', '--reorder', dest="reorder", required=False, action="store_true", help="Instead of diffing, use the local packet counters (iptables-save -c) to move hot rules up their chains where that is safe, and report the rule evaluations saved.")
+    parser.add_argument('--hot-share', dest="hotshare", required=False, type=float, default=0.01, help="With --reorder, only move rules with at least this share of their chain's packets (default: %(default)s).")
+    parser.add_argument('--reorder-file', dest="reorderfile", required=False, help="With --reorder, write the reordered ruleset to this file, for iptables-restore.")
+    parser.add_argument('-S', '--shadowed', dest="shadowed", required=False, action="store_true", help="Instead of diffing, find local rules that can never match because an earlier rule covers them, and duplicate rules.")
+    parser.add_argument('--prune-file', dest="prunefile", required=False, help="With --shadowed, write the ruleset without the dead rules to this file, for iptables-restore.")
+    args = parser.parse_args()
+    if not args.template and not (args.reorder or args.shadowed):
+        parser.error("a --template is needed unless using --reorder or --shadowed")
+    if args.watch is not None and (args.watch <= 0 or args.dumpdir or args.reorder or args.shadowed):
+        parser.error("--watch needs a positive interval, and a --template to diff against")
+
+    if args.debug:
+        print("DEBUG: Arguments parsed:")
+        pp.pprint(vars(args))
+
+    if args.shadowed:
+        try:
+            local = Ruleset.parse(read_local(args.local, args.ipv6))
+            (report, pruned) = shadow_report(local)
+            if args.prunefile:
+                with open(args.prunefile, 'w') as out:
+                    out.write(render_ruleset(local, pruned))
+        except (OSError, ValueError, subprocess.CalledProcessError) as err:
+            print("ERROR: {0}".format(err), file=sys.stderr)
+            sys.exit(2)
+        if args.json:
+            print(json.dumps(report, indent=2))
+        elif not args.quiet:
+            print_shadowed(report, args.verbose or args.debug)
+        sys.exit(1 if report else 0)
+
+    if args.reorder:
+        try:
+            local = Ruleset.parse(read_local(args.local, args.ipv6, counters=True))
+            (report, reordered) = reorder_report(local, args.hotshare)
+            if args.reorderfile:
+                with open(args.reorderfile, 'w') as out:
+                    out.write(render_ruleset(local, reordered))
+        except (OSError, ValueError, subprocess.CalledProcessError) as err:
+            print("ERROR: {0}".format(err), file=sys.stderr)
+            sys.exit(2)
+        if args.json:
+            print(json.dumps(report, indent=2))
+        elif not args.quiet:
+            print_reorder(report, args.verbose or args.debug)
+        sys.exit(0)
+
+    if args.watch:
+        try:
+            watch(args)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    # read in the template and the output from `iptables-save`
+    try:
+        with open(args.template, 'r') as f:
+            template = Ruleset.parse(f)
+        if args.dumpdir:
+            report = fleet_report(template, args.template, args.dumpdir, args.processes)
+            if not args.quiet:
+                print(json.dumps(report, indent=2))
+            sys.exit(1 if report['drifted'] or report['errors'] else 0)
+        local = Ruleset.parse(read_local(args.local, args.ipv6))
+    except (OSError, ValueError, subprocess.CalledProcessError) as err:
+        print("ERROR: {0}".format(err), file=sys.stderr)
+        sys.exit(2)
+
+    try:
+        diffs = check_rules(template, local, args)
+    except (OSError, subprocess.CalledProcessError) as err:
+        print("ERROR: {0}".format(err), file=sys.stderr)
+        sys.exit(2)
+    sys.exit(1 if diffs else 0)
+
 
 if __name__ == "__main__":
     main()
@@ -1,33 +1,694 @@
 #!/usr/bin/python3
 
 import os
+import re
 import sys
+import time
+import yaml
 import os.path
+import sqlite3
+import bisect
+import hashlib
 import argparse
-import datetime
+import json
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+MAX_AGE_DAYS = 90
+STATE_BATCH = 10000
+PRESSURE_FILE = '/proc/pressure/io'
+# lower bounds, in days, of the age buckets in --report
+AGE_BUCKETS = (0, 30, 60, 90, 180, 365)
+
+# one scanned directory: its mtime, the files of interest in it, the
+# subdirectories to visit next (with their stat), the oldest file it is keeping, and how
+# many entries it held (None when it was not listed); with --report,
+# usage maps each age bucket to [files, bytes] of what the rules match,
+# and 'reclaim' to what they would delete now; failed is True if listing
+# it failed, so that oldest means nothing and it must be listed next time
+DirScan = namedtuple('DirScan', ['path', 'mtime_ns', 'files', 'subdirs', 'oldest', 'nentries', 'usage', 'failed'],
+	defaults=(False,))
+
+# a retention rule from the policy file: files under root matching one of
+# the include patterns, and none of the exclude patterns, are deleted once
+# they are max_age days old
+Rule = namedtuple('Rule', ['root', 'include', 'exclude', 'max_age'])
+
+def parse_size(value):
+	"""
+	Parse a byte count like 512, 64K, 20M or 1G.
+
+	Returns:
+		size (int): the number of bytes
+	"""
+	units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+	value = value.strip().upper()
+	try:
+		if value and value[-1] in units:
+			return int(float(value[:-1]) * units[value[-1]])
+		return int(value)
+	except ValueError:
+		raise argparse.ArgumentTypeError("invalid size: {0}".format(value))
+
+def parse_device_jobs(value):
+	"""
+	Parse a MOUNT=N concurrency limit for one filesystem.
+
+	Returns:
+		(dev, jobs): st_dev of the mount, and the number of workers
+	"""
+	(mount, sep, jobs) = value.rpartition('=')
+	try:
+		if not sep or int(jobs) < 1:
+			raise ValueError
+		return (os.stat(mount).st_dev, int(jobs))
+	except ValueError:
+		raise argparse.ArgumentTypeError("expected MOUNT=N, got {0}".format(value))
+	except OSError as err:
+		raise argparse.ArgumentTypeError(str(err))
 
 def parse_args():
 	parser = argparse.ArgumentParser(description="Delete old files.")
 	parser.add_argument('-v', '--verbose', dest="verbose", required=False, action="store_true", help="Increase output verbosity.")
-	parser.add_argument('-d', '--directory', dest="workdir", required=True, help="Specify the directory to search for old files.")
+	where = parser.add_mutually_exclusive_group(required=True)
+	where.add_argument('-d', '--directory', dest="workdir", help="Specify the directory to search for old files.")
+	where.add_argument('-p', '--policy', dest="policy", help="Read retention rules (root, include, exclude, max_age) from this YAML file.")
+	parser.add_argument('-a', '--max-age', dest="maxage", required=False, type=float, default=MAX_AGE_DAYS, help="Age in days at which files under --directory are deleted (default: %(default)s).")
+	parser.add_argument('-j', '--jobs', dest="jobs", required=False, type=int, default=min(32, (os.cpu_count() or 1) * 4), help="Number of directories to scan in parallel on each filesystem.")
+	parser.add_argument('--device-jobs', dest="devicejobs", required=False, action="append", default=[], type=parse_device_jobs, metavar="MOUNT=N", help="Scan up to N directories in parallel on the filesystem mounted at MOUNT, instead of --jobs. May be repeated.")
+	parser.add_argument('--max-unlinks', dest="maxunlinks", required=False, type=int, default=0, help="Limit deletion to this many files per second (0 is unlimited).")
+	parser.add_argument('--max-bytes', dest="maxbytes", required=False, type=parse_size, default=0, help="Limit deletion to this many bytes per second, with an optional K/M/G suffix (0 is unlimited).")
+	parser.add_argument('--io-pressure', dest="iopressure", required=False, type=float, default=0, help="Pause deletion while the 10s average in %s is above this percentage (0 disables)." % PRESSURE_FILE)
+	parser.add_argument('-P', '--prune-dirs', dest="prune", required=False, action="store_true", help="Also remove directories that are empty after the purge and whose mtime is past the cutoff.")
+	parser.add_argument('-r', '--report', dest="report", required=False, action="store_true", help="Delete nothing; stream JSON lines of the files and bytes the rules match per directory and age bucket, and what they would reclaim.")
+	parser.add_argument('-s', '--state-file', dest="statefile", required=False, help="Keep an index of directory mtimes in this sqlite file, and skip directories that have not changed and hold nothing old enough to delete.")
 	args = parser.parse_args()
 	return args
 
+def glob_to_re(pattern):
+	"""
+	Translate a shell glob into a regex. Unlike fnmatch, * and ? do not
+	match '/', while ** matches across directories.
+
+	Returns:
+		regex (str): the untethered regex for the glob
+	"""
+	out = list()
+	i = 0
+	while i < len(pattern):
+		if pattern.startswith('**/', i):
+			out.append('(?:.*/)?')
+			i += 3
+			continue
+		if pattern.startswith('**', i):
+			out.append('.*')
+			i += 2
+			continue
+		c = pattern[i]
+		j = pattern.find(']', i + 2) if c == '[' else -1
+		if c == '*':
+			out.append('[^/]*')
+		elif c == '?':
+			out.append('[^/]')
+		elif j != -1:
+			body = pattern[i + 1:j].replace('\\', '\\\\')
+			if body.startswith('!'):
+				body = '^' + body[1:]
+			out.append('[' + body + ']')
+			i = j
+		else:
+			out.append(re.escape(c))
+		i += 1
+	return ''.join(out)
+
+def pattern_to_re(pattern):
+	"""
+	Translate one include/exclude pattern, relative to a rule's root.
+	Globs without a '/' match the file name at any depth, other globs
+	match the whole relative path, and 're:' patterns are regexes
+	searched for anywhere in the relative path.
+
+	Returns:
+		regex (str): regex matching the path relative to the root
+	"""
+	if pattern.startswith('re:'):
+		return '.*?(?:{0}).*'.format(pattern[3:])
+	if '/' not in pattern:
+		return '(?:.*/)?' + glob_to_re(pattern)
+	return glob_to_re(pattern.lstrip('/'))
+
+def rule_to_re(rule, patterns):
+	"""
+	Build the anchored regex for a list of a rule's patterns.
+
+	Returns:
+		regex (str): matches full paths under the rule's root
+	"""
+	alts = '|'.join(pattern_to_re(p) for p in patterns)
+	return '{0}/(?:{1})\\Z'.format(re.escape(rule.root.rstrip('/')), alts)
+
+class Policy:
+	"""
+	The retention rules that apply to one walk. All of the rules' include
+	patterns are compiled into a single regex, so that one match per file
+	finds the first rule that may apply; rules are checked in order and
+	the first that includes (and does not exclude) a file sets its age.
+	"""
+
+	def __init__(self, rules, now):
+		self.rules = rules
+		self.now = now
+		self.cutoffs = [now - r.max_age * 86400 for r in rules]
+		# the latest cutoff; nothing newer than this can be deleted
+		self.max_cutoff = max(self.cutoffs)
+		self.includes = [re.compile(rule_to_re(r, r.include), re.S) for r in rules]
+		self.excludes = [re.compile(rule_to_re(r, r.exclude), re.S) if r.exclude else None for r in rules]
+		self.combined = re.compile('|'.join('(?P<r{0}>{1})'.format(i, rule_to_re(r, r.include)) for (i, r) in enumerate(rules)), re.S)
+
+	def fingerprint(self):
+		"""
+		Returns:
+			digest (str): hash of the rules, to notice when they change
+		"""
+		return hashlib.sha1(repr(self.rules).encode()).hexdigest()
+
+	def cutoff(self, path):
+		"""
+		Find the cutoff for a file from the first rule that applies to it.
+
+		Returns:
+			cutoff (float): delete the file if its mtime is at or before
+				this, or None if no rule applies
+		"""
+		m = self.combined.match(path)
+		if not m:
+			return None
+		for i in range(int(m.lastgroup[1:]), len(self.rules)):
+			if not self.includes[i].match(path):
+				continue
+			if self.excludes[i] and self.excludes[i].match(path):
+				continue
+			return self.cutoffs[i]
+		return None
+
+	def dir_cutoff(self, path):
+		"""
+		Find the cutoff for a directory, from the first rule whose root it
+		is below. Roots themselves are never given a cutoff.
+
+		Returns:
+			cutoff (float): mtime at or before which the directory may be
+				removed once empty, or None
+		"""
+		for (rule, cutoff) in zip(self.rules, self.cutoffs):
+			if path.startswith(os.path.join(rule.root, '')):
+				return cutoff
+		return None
+
+def load_policy(policy_file):
+	"""
+	Read the retention rules from a YAML policy file, either a list of
+	rules or a mapping with a 'rules' list. Each rule needs a root and a
+	max_age in days; include defaults to every file.
+
+	Returns:
+		rules (list): list of Rule
+	"""
+	with open(policy_file, 'r') as f:
+		data = yaml.safe_load(f)
+	if isinstance(data, dict):
+		data = data.get('rules')
+	if not isinstance(data, list) or not data:
+		raise ValueError("no rules found in {0}".format(policy_file))
+	rules = list()
+	for (n, r) in enumerate(data, 1):
+		if not isinstance(r, dict) or 'root' not in r or 'max_age' not in r:
+			raise ValueError("rule {0} in {1} needs a root and a max_age".format(n, policy_file))
+		include = r.get('include') or ['**']
+		exclude = r.get('exclude') or []
+		if isinstance(include, str):
+			include = [include]
+		if isinstance(exclude, str):
+			exclude = [exclude]
+		rules.append(Rule(os.path.abspath(r['root']), tuple(include), tuple(exclude), float(r['max_age'])))
+	return rules
+
+def plan_walks(rules):
+	"""
+	Group rules under their outermost root, so that overlapping trees are
+	walked only once.
+
+	Returns:
+		walks (list): (root, [rules]) tuples
+	"""
+	tops = list()
+	for root in sorted(set(r.root for r in rules)):
+		if not any(root == t or root.startswith(os.path.join(t, '')) for t in tops):
+			tops.append(root)
+	return [(t, [r for r in rules if r.root == t or r.root.startswith(os.path.join(t, ''))]) for t in tops]
+
+def open_state(state_file):
+	"""
+	Open (and create, if needed) the sqlite index of directory mtimes.
+
+	Returns:
+		db (sqlite3.Connection): connection to the state file
+	"""
+	db = sqlite3.connect(state_file)
+	db.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER, oldest REAL, run INTEGER)")
+	db.execute("CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)")
+	db.execute("CREATE TABLE IF NOT EXISTS roots (root TEXT PRIMARY KEY, policy TEXT)")
+	return db
+
+def load_state(db, root, policy):
+	"""
+	Load the index entries for the tree under root. If the rules for
+	the root have changed since the last run the index is ignored, as
+	files it passed over may match now.
+
+	Returns:
+		index (dict): path -> (mtime_ns, oldest, [subdirs])
+	"""
+	index = dict()
+	parents = list()
+	fingerprint = policy.fingerprint()
+	known = db.execute("SELECT policy FROM roots WHERE root = ?", (root,)).fetchone()
+	db.execute("INSERT OR REPLACE INTO roots (root, policy) VALUES (?, ?)", (root, fingerprint))
+	if not known or known[0] != fingerprint:
+		return index
+	prefix = os.path.join(root, '')
+	rows = db.execute("SELECT path, parent, mtime_ns, oldest FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?",
+		(root, len(prefix), prefix))
+	for (path, parent, mtime_ns, oldest) in rows:
+		index[path] = (mtime_ns, oldest, list())
+		parents.append((path, parent))
+	for (path, parent) in parents:
+		if parent in index:
+			index[parent][2].append(path)
+	return index
+
+def save_state(db, batch):
+	"""
+	Upsert a batch of (path, parent, mtime_ns, oldest, run) rows.
+	"""
+	db.executemany("INSERT OR REPLACE INTO dirs (path, parent, mtime_ns, oldest, run) VALUES (?, ?, ?, ?, ?)", batch)
+	batch.clear()
+
+def expire_state(db, root, run):
+	"""
+	Drop index entries under root that were not seen on this run, and commit.
+	"""
+	prefix = os.path.join(root, '')
+	db.execute("DELETE FROM dirs WHERE run != ? AND (path = ? OR substr(path, 1, ?) = ?)",
+		(run, root, len(prefix), prefix))
+	db.commit()
+
+def scan_dir(path, st, policy, verbose=False, index=None, report=False):
+	"""
+	Scan a single directory, reusing the stat cached on each DirEntry.
+	Files are matched against the policy before they are stat'd, and
+	subdirectories are stat'd here, so that walk() can tell which
+	filesystem they are on.
+
+	If the index says the directory has not changed since the last run,
+	and nothing in it was old enough to reach the cutoff yet, its files
+	are not listed or stat'd at all.
+
+	When reporting, files are only tallied into usage, so that a huge
+	directory costs no more memory than a small one.
+
+	Returns:
+		DirScan: files holds (name, mtime, size, cutoff) for every file at
+			or past its rule's cutoff, or for every file when verbose;
+			failed is set if the directory could not be listed
+	"""
+	files = list()
+	subdirs = list()
+	oldest = None
+	usage = dict() if report else None
+	mtime_ns = st.st_mtime_ns
+	known = index.get(path) if index else None
+	if known and known[0] == mtime_ns and (known[1] is None or known[1] > policy.max_cutoff):
+		for child in known[2]:
+			try:
+				subdirs.append((child, os.stat(child, follow_symlinks=False)))
+			except OSError:
+				pass
+		return DirScan(path, mtime_ns, files, subdirs, known[1], None, usage)
+	nentries = 0
+	try:
+		with os.scandir(path) as it:
+			for entry in it:
+				nentries += 1
+				try:
+					if entry.is_dir():
+						# like os.walk, don't descend into symlinked dirs
+						if not entry.is_symlink():
+							subdirs.append((entry.path, entry.stat(follow_symlinks=False)))
+						continue
+					cutoff = policy.cutoff(entry.path)
+					if cutoff is None and not verbose:
+						continue
+					fst = entry.stat()
+				except OSError:
+					# removed (or a dangling link) since readdir
+					continue
+				mtime = fst.st_mtime
+				expired = cutoff is not None and mtime <= cutoff
+				if report:
+					if cutoff is not None:
+						age = max(0, (policy.now - mtime) / 86400)
+						tally(usage, AGE_BUCKETS[bisect.bisect_right(AGE_BUCKETS, age) - 1], fst.st_size)
+						if expired:
+							tally(usage, 'reclaim', fst.st_size)
+				elif verbose or expired:
+					files.append((entry.name, mtime, fst.st_size, cutoff))
+				# count files left behind too, in case their unlink fails
+				if cutoff is not None and (oldest is None or mtime < oldest):
+					oldest = mtime
+	except OSError as err:
+		print("Unable to scan {0}: {1}".format(path, err), file=sys.stderr)
+		return DirScan(path, mtime_ns, files, subdirs, oldest, None, usage, True)
+	return DirScan(path, mtime_ns, files, subdirs, oldest, nentries, usage)
+
+def tally(usage, key, size):
+	"""
+	Add one file of size bytes to usage[key].
+	"""
+	agg = usage.setdefault(key, [0, 0])
+	agg[0] += 1
+	agg[1] += size
+
+class DevicePool:
+	"""
+	Worker pool, backlog and concurrency limit for one filesystem.
+	"""
+
+	def __init__(self, jobs):
+		self.jobs = jobs
+		self.executor = ThreadPoolExecutor(max_workers=jobs)
+		self.backlog = deque()
+		self.inflight = 0
+
+def walk(root, policy, jobs, verbose=False, index=None, device_jobs=None, report=False):
+	"""
+	Walk the tree under root. Directories are grouped by st_dev, and each
+	filesystem gets its own pool of workers (jobs, or its entry in
+	device_jobs), so that a slow volume does not hold up the others.
+
+	Yields:
+		DirScan for each directory, as returned by scan_dir()
+	"""
+	device_jobs = device_jobs or dict()
+	pools = dict()
+	pending = dict()
+
+	def queue(path, st):
+		if st.st_dev not in pools:
+			pools[st.st_dev] = DevicePool(device_jobs.get(st.st_dev, jobs))
+		pools[st.st_dev].backlog.append((path, st))
+
+	try:
+		queue(root, os.stat(root))
+	except OSError as err:
+		print("Unable to scan {0}: {1}".format(root, err), file=sys.stderr)
+		return
+	try:
+		while pending or any(pool.backlog for pool in pools.values()):
+			# keep the number of directories in flight on each device
+			# bounded, depth first
+			for (dev, pool) in pools.items():
+				while pool.backlog and pool.inflight < pool.jobs * 2:
+					(path, st) = pool.backlog.pop()
+					pending[pool.executor.submit(scan_dir, path, st, policy, verbose, index, report)] = dev
+					pool.inflight += 1
+			done, _ = wait(pending, return_when=FIRST_COMPLETED)
+			for fut in done:
+				pools[pending.pop(fut)].inflight -= 1
+				scan = fut.result()
+				for (path, st) in scan.subdirs:
+					queue(path, st)
+				yield scan
+	finally:
+		for pool in pools.values():
+			pool.executor.shutdown(cancel_futures=True)
+
+class ReclaimReport:
+	"""
+	Streams one JSON line per directory holding files the rules match,
+	then a line of totals. Only the totals are kept, so memory does not
+	grow with the size of the tree.
+	"""
+
+	def __init__(self, out=sys.stdout):
+		self.out = out
+		self.dirs = 0
+		self.totals = dict()
+
+	def format(self, usage):
+		"""
+		Returns:
+			dict: files, bytes, reclaim and per-bucket totals for usage
+		"""
+		buckets = [k for k in AGE_BUCKETS if k in usage]
+		return {
+			'files': sum(usage[k][0] for k in buckets),
+			'bytes': sum(usage[k][1] for k in buckets),
+			'reclaim_files': usage.get('reclaim', [0, 0])[0],
+			'reclaim_bytes': usage.get('reclaim', [0, 0])[1],
+			'buckets': dict((str(k), {'files': usage[k][0], 'bytes': usage[k][1]}) for k in buckets),
+		}
+
+	def add(self, scan):
+		"""
+		Write the line for a scanned directory, and add it to the totals.
+		"""
+		if not scan.usage:
+			return
+		self.dirs += 1
+		for (k, (n, size)) in scan.usage.items():
+			agg = self.totals.setdefault(k, [0, 0])
+			agg[0] += n
+			agg[1] += size
+		line = {'dir': scan.path}
+		line.update(self.format(scan.usage))
+		print(json.dumps(line), file=self.out)
+
+	def finish(self):
+		"""
+		Write the line of totals.
+		"""
+		line = {'total': True, 'dirs': self.dirs}
+		line.update(self.format(self.totals))
+		print(json.dumps(line), file=self.out)
+
+class TokenBucket:
+	"""
+	Rate limiter that lets a cost run into debt, then sleeps it off.
+	A rate of 0 never blocks.
+	"""
+
+	def __init__(self, rate):
+		self.rate = rate
+		self.tokens = rate
+		self.stamp = time.monotonic()
+
+	def take(self, cost=1):
+		"""Spend cost tokens, sleeping if that leaves the bucket in debt."""
+		if not self.rate:
+			return
+		now = time.monotonic()
+		self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp = now
+		self.tokens -= cost
+		if self.tokens < 0:
+			time.sleep(-self.tokens / self.rate)
+
+class Deleter:
+	"""
+	Deletion stage: unlinks the old files found by the scan, relative to
+	an fd on their directory, within an unlinks/sec and bytes/sec budget,
+	and backs off while the host is under I/O pressure.
+	"""
+
+	def __init__(self, now, unlinks=0, nbytes=0, pressure=0, verbose=False):
+		self.now = now
+		self.unlinks = TokenBucket(unlinks)
+		self.nbytes = TokenBucket(nbytes)
+		self.pressure = pressure if os.path.exists(PRESSURE_FILE) else 0
+		self.checked = 0
+		self.verbose = verbose
+
+	def io_pressure(self):
+		"""
+		Read the 10s average of the "some" line in /proc/pressure/io.
+
+		Returns:
+			avg10 (float): percentage of time tasks were stalled on I/O
+		"""
+		with open(PRESSURE_FILE, 'r') as psi:
+			for l in psi:
+				if l.startswith('some'):
+					return float(l.split()[1].split('=')[1])
+		return 0.0
+
+	def wait_for_pressure(self):
+		"""Sleep while I/O pressure is over the limit, checking at most once a second."""
+		if not self.pressure or time.monotonic() - self.checked < 1:
+			return
+		while self.io_pressure() > self.pressure:
+			if self.verbose:
+				print("I/O pressure above {0}%, backing off".format(self.pressure))
+			time.sleep(1)
+		self.checked = time.monotonic()
+
+	def purge(self, scan):
+		"""
+		Remove the files in a DirScan that are at or past their cutoff.
+
+		Returns:
+			removed (int): number of files unlinked
+		"""
+		removed = 0
+		dirfd = None
+		try:
+			for (name, mtime, size, cutoff) in scan.files:
+				fqfile = os.path.join(scan.path, name)
+				datediff = (self.now - mtime) / 86400
+				if self.verbose:
+					print("Got mtime ({0}); now ({1}); diff ({2})".format(mtime, self.now, datediff))
+				if cutoff is None or mtime > cutoff:
+					continue
+				print("{0}, {1:.2f}, {2:.2f}".format(fqfile, mtime, datediff))
+				self.wait_for_pressure()
+				self.unlinks.take()
+				self.nbytes.take(size)
+				try:
+					if dirfd is None:
+						dirfd = os.open(scan.path, os.O_RDONLY | os.O_DIRECTORY)
+					os.unlink(name, dir_fd=dirfd)
+					removed += 1
+				except OSError as err:
+					print("Unable to remove {0}: {1}".format(fqfile, err), file=sys.stderr)
+		finally:
+			if dirfd is not None:
+				os.close(dirfd)
+		return removed
+
+	def remove_dir(self, path, mtime):
+		"""
+		Remove an empty directory, within the same budget as files.
+
+		Returns:
+			bool: True if the directory was removed
+		"""
+		print("{0}/, {1:.2f}, {2:.2f}".format(path, mtime, (self.now - mtime) / 86400))
+		self.wait_for_pressure()
+		self.unlinks.take()
+		try:
+			os.rmdir(path)
+		except OSError as err:
+			print("Unable to remove {0}: {1}".format(path, err), file=sys.stderr)
+			return False
+		return True
+
+class Pruner:
+	"""
+	Removes directories left empty by the purge, in post-order, during the
+	same walk. Each directory counts down its remaining entries as files
+	and subdirectories are removed, and its unfinished subdirectories as
+	their scans complete; when that reaches zero it is finished, and if
+	nothing is left in it (and it is old enough) it is removed in turn.
+	"""
+
+	def __init__(self, root, policy, deleter):
+		self.root = root
+		self.policy = policy
+		self.deleter = deleter
+		# path -> [entries left, subdirs unfinished, mtime]
+		self.nodes = dict()
+
+	def add(self, scan, removed):
+		"""
+		Track a scanned directory, after removed of its files were deleted.
+		"""
+		entries = None if scan.nentries is None else scan.nentries - removed
+		self.nodes[scan.path] = [entries, len(scan.subdirs), scan.mtime_ns / 1e9]
+		if not scan.subdirs:
+			self.finish(scan.path)
+
+	def finish(self, path):
+		"""
+		Finish a directory, then any ancestors it was the last one left in.
+		"""
+		while path is not None:
+			(entries, _, mtime) = self.nodes.pop(path)
+			gone = False
+			if entries == 0 and path != self.root:
+				cutoff = self.policy.dir_cutoff(path)
+				if cutoff is not None and mtime <= cutoff:
+					gone = self.deleter.remove_dir(path, mtime)
+			parent = os.path.dirname(path) if path != self.root else None
+			path = None
+			if parent in self.nodes:
+				node = self.nodes[parent]
+				node[1] -= 1
+				if gone and node[0] is not None:
+					node[0] -= 1
+				if node[1] == 0:
+					path = parent
+
 def main():
 	args = parse_args()
 
-	now = datetime.datetime.now()
-	for (dirpath, dirnames, filenames) in os.walk(args.workdir):
-		for f in filenames:
-			fqfile = os.path.join(dirpath, f)
-            # get dires too
-			#if os.path.isfile(fqfile):
-			datediff = (float(now.strftime('%s')) - os.path.getmtime(fqfile)) / 86400
-			if args.verbose:
-				print("Got mtime ({0}); now ({1}); diff ({2})".format(os.path.getmtime(fqfile), now.strftime('%s'), datediff))
-			if datediff >= 90:
-				print("{0}, {1:.2f}, {2:.2f}".format(fqfile, os.path.getmtime(fqfile), datediff))
-				os.remove(fqfile)
+	# work out the cutoffs once, rather than per file
+	now = int(time.time())
+	if args.policy:
+		try:
+			rules = load_policy(args.policy)
+		except (OSError, ValueError, yaml.YAMLError) as err:
+			print("Unable to load policy: {0}".format(err), file=sys.stderr)
+			sys.exit(1)
+	else:
+		rules = [Rule(os.path.abspath(args.workdir), ('**',), (), args.maxage)]
+
+	# a report deletes nothing, so it neither trusts nor updates the index
+	db = None
+	if args.statefile and not args.report:
+		db = open_state(args.statefile)
+	reporter = ReclaimReport() if args.report else None
+
+	deleter = Deleter(now, args.maxunlinks, args.maxbytes, args.iopressure, args.verbose)
+	for (root, walk_rules) in plan_walks(rules):
+		policy = Policy(walk_rules, now)
+		index = None
+		batch = list()
+		pruner = Pruner(root, policy, deleter) if args.prune and not reporter else None
+		if db:
+			index = load_state(db, root, policy)
+		for scan in walk(root, policy, args.jobs, args.verbose, index, dict(args.devicejobs), bool(reporter)):
+			if reporter:
+				reporter.add(scan)
+				continue
+			if db:
+				# a directory that could not be listed is indexed without an
+				# mtime, so that the next run lists it again; leaving it out
+				# would hide it from an unchanged parent
+				parent = os.path.dirname(scan.path) if scan.path != root else None
+				batch.append((scan.path, parent, None if scan.failed else scan.mtime_ns, scan.oldest, now))
+				if len(batch) >= STATE_BATCH:
+					save_state(db, batch)
+			removed = deleter.purge(scan)
+			if pruner:
+				pruner.add(scan, removed)
+		if db:
+			save_state(db, batch)
+			expire_state(db, root, now)
+
+	if reporter:
+		reporter.finish()
+	if db:
+		db.close()
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+bench-setupfw.py
+
+Generate setupfw.py policies of a given size, render them to
+iptables-restore files offline, and time how long that takes, so we can
+see at which ruleset size firewall setup starts to dominate boot time.
+
+For each size this reports the time to build the rules, the time to
+render them, the size of the restore file and, when run as root with
+`ip` and `iptables-restore` available, the time iptables-restore takes
+to load the file into a scratch network namespace (which leaves the
+host firewall alone). Results are appended as one JSON object per line
+to the --output file.
+
+Usage:
+  ./bench-setupfw.py --sizes 1000 10000 100000
+  sudo ./bench-setupfw.py --netns --repeat 3 -o bench.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+from typing import Dict, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import setupfw
+
+
+def synthetic_policy(size: int, seed: int) -> Tuple[Dict, Dict]:
+    """
+    Build the usual setupfw.py policy, plus enough per-source TCP accept
+    rules (random /32s and ports, the shape of a per-host allow list) for
+    the filter table to hold `size` rules in all.
+
+    Returns:
+        (policies, rules) as from setupfw.build_rules()
+    """
+    rng = random.Random(seed)
+    (policies, rules) = setupfw.build_rules(['eth0'], ['22'], ['53'])
+    extra = size - sum(len(r) for r in rules.values())
+    rules['TCP'][:0] = [
+        {'protocol': 'tcp', 'src': '10.{0}.{1}.{2}/32'.format(rng.randrange(256), rng.randrange(256), rng.randrange(1, 255)),
+         'tcp': {'dport': str(rng.randrange(1, 65536))}, 'target': 'ACCEPT'}
+        for _ in range(max(0, extra))
+    ]
+    return (policies, rules)
+
+
+def restore_in_netns(path: str) -> Tuple[Optional[float], Optional[str]]:
+    """
+    Time `iptables-restore` loading a file into a fresh network namespace.
+
+    Returns:
+        (seconds, error): the load time, or None and why it was skipped
+            or failed
+    """
+    if os.geteuid() != 0:
+        return (None, 'not root')
+    for tool in ('ip', 'iptables-restore'):
+        if not shutil.which(tool):
+            return (None, tool + ' not found')
+    name = 'bench-setupfw-{0}'.format(os.getpid())
+    try:
+        subprocess.run(['ip', 'netns', 'add', name], check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as err:
+        return (None, err.stderr.strip())
+    try:
+        start = time.monotonic()
+        proc = subprocess.run(['ip', 'netns', 'exec', name, 'iptables-restore', path], capture_output=True, text=True)
+        seconds = time.monotonic() - start
+        if proc.returncode != 0:
+            return (None, proc.stderr.strip())
+        return (seconds, None)
+    finally:
+        subprocess.run(['ip', 'netns', 'delete', name], capture_output=True)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark rendering (and loading) setupfw.py policies of a given size.")
+    parser.add_argument('-s', '--sizes', dest='sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="Rules per policy to benchmark (default: 1000 10000 100000).")
+    parser.add_argument('--repeat', dest='repeat', type=int, default=1, help="Runs per size.")
+    parser.add_argument('--seed', dest='seed', type=int, default=42, help="Seed for the generated rules.")
+    parser.add_argument('--netns', dest='netns', action='store_true', help="Also time iptables-restore loading each file into a scratch network namespace (needs root).")
+    parser.add_argument('-t', '--tmpdir', dest='tmpdir', default=None, help="Where to write the restore files.")
+    parser.add_argument('-o', '--output', dest='output', help="Append the results to this file as a JSON line.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    result = {
+        'timestamp': int(time.time()),
+        'host': socket.gethostname(),
+        'python': sys.version.split()[0],
+        'params': {'sizes': args.sizes, 'seed': args.seed, 'netns': args.netns},
+        'runs': list(),
+    }
+
+    workdir = tempfile.mkdtemp(prefix='bench-fw-', dir=args.tmpdir)
+    try:
+        for size in args.sizes:
+            for n in range(args.repeat):
+                start = time.monotonic()
+                (policies, rules) = synthetic_policy(size, args.seed)
+                build = time.monotonic() - start
+                start = time.monotonic()
+                text = setupfw.render_restore([('filter', policies, rules)])
+                render = time.monotonic() - start
+                path = os.path.join(workdir, 'rules-{0}.txt'.format(size))
+                with open(path, 'w') as out:
+                    out.write(text)
+                run = {
+                    'size': size,
+                    'run': n + 1,
+                    'rules': sum(len(r) for r in rules.values()),
+                    'build_seconds': round(build, 4),
+                    'render_seconds': round(render, 4),
+                    'bytes': os.path.getsize(path),
+                }
+                if args.netns:
+                    (seconds, error) = restore_in_netns(path)
+                    run['restore_seconds'] = round(seconds, 4) if seconds is not None else None
+                    if error:
+                        run['restore_error'] = error
+                result['runs'].append(run)
+                print("{size} rules #{run}: build {build_seconds}s, render {render_seconds}s, {bytes} bytes".format(**run)
+                      + (", restore {0}s".format(run['restore_seconds']) if run.get('restore_seconds') is not None else '')
+                      + (" (restore skipped: {0})".format(run['restore_error']) if run.get('restore_error') else ''))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'a') as out:
+            out.write(json.dumps(result) + '\n')
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,14 +7,75 @@ already running on the system and create ACCEPT rules for
 those ports and services.
 
 It will also attempt to set up some very basic rules
-for a simple, stateful iptables firewall.
+for a simple, stateful iptables firewall, or the same policy as an
+nftables ruleset.
+
+All rules are generated first, as python-iptables rule dicts (the
+iptc.easy format), and then written in one transaction: with autocommit
+off, every change goes to one in-memory copy of the filter table, which
+is committed to the kernel once, or thrown away if anything fails.
+python-iptables is only imported then, so rendering the rules to a file
+(-o, --nft-file) works without it.
 """
 
-import iptc
+import os
 import pprint
 import argparse
+import socket
+import ipaddress
+import subprocess
+from collections import Counter, namedtuple
 from termcolor import cprint
 
+# our own chains, created if missing, and the built-in ones, in the order
+# their rules are written
+USER_CHAINS = ('TCP', 'UDP', 'LOGGING')
+FILTER_CHAINS = USER_CHAINS + ('INPUT', 'OUTPUT', 'FORWARD')
+
+# the conntrack fast path: once a connection is up, every packet of it
+# should be accepted by the first rule it meets
+FAST_PATH = {'conntrack': {'ctstate': 'RELATED,ESTABLISHED'}, 'target': 'ACCEPT'}
+FAST_PATH_CHAINS = ('INPUT', 'OUTPUT', 'FORWARD')
+
+# the built-in chains of the tables we write, for iptables-restore files
+BUILTIN_CHAINS = {
+    'filter': ('INPUT', 'FORWARD', 'OUTPUT'),
+    'raw': ('PREROUTING', 'OUTPUT'),
+}
+
+# iptc.easy rule keys that are iptables options rather than match modules
+BASIC_KEYS = {'protocol': '-p', 'src': '-s', 'dst': '-d', 'in-interface': '-i', 'out-interface': '-o'}
+
+# options whose value is free text, kept as one (quoted) argument
+TEXT_OPTS = {'log-prefix', 'comment', 'nflog-prefix'}
+
+# a socket waiting for connections or datagrams, from /proc/net: the
+# protocol ('tcp' or 'udp'), the local address and port, the socket inode,
+# the owning uid, and (if asked for) the (pid, command) of the processes
+# holding it open
+Listener = namedtuple('Listener', ['proto', 'addr', 'port', 'inode', 'uid', 'procs'])
+
+# /proc/net files to read, and the socket state that means "listening":
+# TCP_LISTEN for TCP, and TCP_CLOSE (unconnected) for UDP, which the
+# bound sockets of UDP clients are in too; see get_listeners()
+PROC_NET = (('tcp', 'tcp', '0A'), ('tcp6', 'tcp', '0A'), ('udp', 'udp', '07'), ('udp6', 'udp', '07'))
+
+# a blocklist loaded into an ipset: the set name, its type (always
+# hash:net) and the entries, as strings ipset accepts
+Blocklist = namedtuple('Blocklist', ['name', 'settype', 'entries'])
+
+# ipset names are at most 31 characters; the new contents are loaded into
+# NAME + IPSET_TMP_SUFFIX and swapped in
+IPSET_NAME_MAX = 31
+IPSET_TMP_SUFFIX = '-new'
+
+# the nftables table the nftables backend owns; it is replaced whole
+NFT_TABLE = 'setupfw'
+
+# with an aggregation threshold, the widest prefix a blocklist entry may
+# grow into
+AGGREGATE_MIN_PREFIX = 24
+
 def is_root() -> bool:
     """
     Check if the script is being run as root.
@@ -39,19 +100,868 @@ def get_ifaces():
             # skip the header row(s)
             if 'Inter-' in l: continue
             if 'face' in l: continue
+            _if = l.split(':')[0].strip()
             # skip lo, we'll handle that specifically
-            if 'lo' in l: continue
-            _if = l.split(':')[0]
+            if _if == 'lo': continue
             if _if not in ifaces:
                 ifaces.append(_if)
     return ifaces
 
+def decode_addr(hexaddr):
+    """
+    Decode an address from /proc/net, which the kernel prints as the hex
+    of each 32-bit word in host (little-endian) order.
+
+    Returns:
+        addr (IPv4Address or IPv6Address)
+    """
+    raw = bytes.fromhex(hexaddr)
+    return ipaddress.ip_address(b''.join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4)))
+
+
+def parse_proc_net(text, proto, listen_state):
+    """
+    Parse one /proc/net/{tcp,tcp6,udp,udp6} file.
+
+    Args:
+        text (str): the file contents
+        proto (str): 'tcp' or 'udp'
+        listen_state (str): the hex socket state to keep
+
+    Returns:
+        listeners (list): Listener for each listening socket, without procs
+    """
+    listeners = list()
+    for line in text.splitlines()[1:]:
+        # sl local_address rem_address st tx:rx tr:when retrnsmt uid timeout inode ...
+        fields = line.split()
+        if len(fields) < 10 or fields[3] != listen_state:
+            continue
+        (addr, port) = fields[1].split(':')
+        listeners.append(Listener(proto, decode_addr(addr), int(port, 16), int(fields[9]), int(fields[7]), ()))
+    return listeners
+
+
+def socket_owners(inodes, proc='/proc'):
+    """
+    Find the processes holding the given socket inodes open, by reading
+    the /proc/<pid>/fd links. Processes that go away or cannot be read
+    are skipped.
+
+    Returns:
+        owners (dict): inode -> list of (pid, command)
+    """
+    owners = {inode: list() for inode in inodes}
+    for pid in os.listdir(proc):
+        if not pid.isdigit():
+            continue
+        fddir = os.path.join(proc, pid, 'fd')
+        try:
+            fds = os.listdir(fddir)
+            found = set()
+            for fd in fds:
+                try:
+                    link = os.readlink(os.path.join(fddir, fd))
+                except OSError:
+                    continue
+                # socket links read 'socket:[12345]'
+                if link.startswith('socket:['):
+                    inode = int(link[8:-1])
+                    if inode in owners:
+                        found.add(inode)
+            if not found:
+                continue
+            with open(os.path.join(proc, pid, 'comm'), 'r') as f:
+                comm = f.read().strip()
+        except OSError:
+            continue
+        for inode in found:
+            owners[inode].append((int(pid), comm))
+    return owners
+
+
+def local_port_range(proc='/proc'):
+    """
+    Returns:
+        (first, last): the ephemeral port range the kernel picks client
+            ports from, or None if it cannot be read
+    """
+    try:
+        with open(os.path.join(proc, 'sys', 'net', 'ipv4', 'ip_local_port_range'), 'r') as f:
+            (first, last) = f.read().split()
+        return (int(first), int(last))
+    except (OSError, ValueError):
+        return None
+
+
+def get_listeners(proc='/proc', processes=False, loopback=False):
+    """
+    Find the listening TCP and UDP sockets on the system from
+    /proc/net/{tcp,tcp6,udp,udp6}, reading each file once.
+
+    An unconnected UDP socket looks the same whether it is a server's or
+    a client's (a resolver waiting for its answer, say), so UDP sockets
+    on ports in the ephemeral range (local_port_range()) are skipped as
+    clients: a server there must be opened with --udp-port.
+
+    Args:
+        proc (str): where procfs is mounted, or a directory of fixture
+            files laid out the same way (net/tcp, net/udp6, ...)
+        processes (bool): also find the processes that own each socket;
+            this reads every /proc/<pid>/fd, so it is off by default
+        loopback (bool): keep sockets bound to loopback addresses, which
+            are only reachable through lo
+
+    Returns:
+        listeners (list): a Listener per socket
+    """
+    listeners = list()
+    ephemeral = local_port_range(proc)
+    for (name, proto, state) in PROC_NET:
+        try:
+            with open(os.path.join(proc, 'net', name), 'r') as f:
+                text = f.read()
+        except FileNotFoundError:
+            # no IPv6, or no UDP, on this kernel
+            continue
+        for l in parse_proc_net(text, proto, state):
+            addr = l.addr.ipv4_mapped if l.addr.version == 6 and l.addr.ipv4_mapped else l.addr
+            if addr.is_loopback and not loopback:
+                continue
+            if proto == 'udp' and ephemeral and ephemeral[0] <= l.port <= ephemeral[1]:
+                continue
+            listeners.append(l)
+    if processes:
+        owners = socket_owners(set(l.inode for l in listeners), proc)
+        listeners = [l._replace(procs=tuple(owners[l.inode])) for l in listeners]
+    return listeners
+
+
+def listener_ports(listeners, proto):
+    """
+    Returns:
+        ports (list): the distinct ports listened on for proto, in order
+    """
+    return [str(p) for p in sorted(set(l.port for l in listeners if l.proto == proto))]
+
+
+def parse_ipv4_ranges(entries):
+    """
+    Parse IPv4 addresses and CIDRs into integer ranges. inet_pton is
+    used rather than ipaddress, which is several times slower; host bits
+    set in a CIDR are masked off.
+
+    Each range is packed into one int, first << 32 | last, which sorts
+    the same as the (first, last) tuple but a lot faster.
+
+    Returns:
+        (ranges, skipped): a list of packed ranges, and the number of
+            IPv6 or unparseable entries left out
+    """
+    ranges = list()
+    skipped = 0
+    aton = socket.inet_pton
+    for entry in entries:
+        try:
+            if '/' not in entry:
+                first = int.from_bytes(aton(socket.AF_INET, entry), 'big')
+                ranges.append(first << 32 | first)
+                continue
+            (addr, prefix) = entry.split('/', 1)
+            first = int.from_bytes(aton(socket.AF_INET, addr), 'big')
+            size = 1 << (32 - int(prefix))
+        except (OSError, ValueError):
+            skipped += 1
+            continue
+        if not 1 <= size <= 1 << 32:
+            skipped += 1
+            continue
+        first &= ~(size - 1)
+        ranges.append(first << 32 | (first + size - 1))
+    return (ranges, skipped)
+
+
+def merge_ranges(ranges):
+    """
+    Returns:
+        ranges (list): the sorted, disjoint union of the packed ranges,
+            as (first, last) tuples, with overlapping and adjacent ranges
+            merged
+    """
+    merged = list()
+    (cur_first, cur_last) = (None, -2)
+    mask = (1 << 32) - 1
+    for r in sorted(ranges):
+        first = r >> 32
+        if first <= cur_last + 1:
+            last = r & mask
+            if last > cur_last:
+                cur_last = last
+            continue
+        if cur_first is not None:
+            merged.append((cur_first, cur_last))
+        (cur_first, cur_last) = (first, r & mask)
+    if cur_first is not None:
+        merged.append((cur_first, cur_last))
+    return merged
+
+
+def range_to_prefixes(first, last):
+    """
+    Split an address range into the fewest CIDR blocks that cover it
+    exactly: at each step, the largest block aligned on first that fits.
+
+    Returns:
+        prefixes (list): (network int, prefix length)
+    """
+    prefixes = list()
+    while first <= last:
+        size = first & -first or 1 << 32
+        while size > last - first + 1:
+            size >>= 1
+        prefixes.append((first, 33 - size.bit_length()))
+        first += size
+    return prefixes
+
+
+def aggregate_cidrs(entries, threshold=None, min_prefix=AGGREGATE_MIN_PREFIX):
+    """
+    Collapse a list of IPv4 addresses and CIDRs into the smallest set of
+    prefixes covering the same addresses: parse to integer ranges, sort
+    and merge them, then split each merged range back into prefixes.
+
+    With a threshold, any prefix from /31 up to /min_prefix of which at
+    least that percentage of addresses is listed is blocked whole. The
+    share is always taken from the listed addresses, not from blocks
+    already grown, so a single address cannot creep up to a /24.
+
+    Args:
+        entries (iterable): address and CIDR strings
+        threshold (float): percentage, or None to only aggregate exactly
+        min_prefix (int): the shortest prefix the threshold may produce
+
+    Returns:
+        (prefixes, skipped): the prefixes as 'a.b.c.d/n' strings, in
+            address order, and the number of entries left out
+    """
+    (ranges, skipped) = parse_ipv4_ranges(entries)
+    ranges = merge_ranges(ranges)
+    if threshold is not None:
+        grown = list()
+        shift = 32 - min_prefix
+        # single addresses are most of a typical list, and most of them are
+        # alone in their widest block: such a block holds that one address
+        # at every level, so it grows to the widest block one address is
+        # enough for, if any, and is not counted level by level. The ranges
+        # are sorted and disjoint, so anything else in the block is next to
+        # the address in the list
+        before = [-1] + [last >> shift for (first, last) in ranges[:-1]]
+        after = [first >> shift for (first, last) in ranges[1:]] + [-1]
+        lone = [first for ((first, last), b, a) in zip(ranges, before, after)
+                if first == last and b != first >> shift != a]
+        singles = [first for ((first, last), b, a) in zip(ranges, before, after)
+                   if first == last and not b != first >> shift != a]
+        wider = [(first, last) for (first, last) in ranges if first != last]
+        widest = None
+        for prefix in range(31, min_prefix - 1, -1):
+            if (1 << (32 - prefix)) * threshold / 100.0 <= 1:
+                widest = 32 - prefix
+        if widest is None:
+            grown.extend([first << 32 | first for first in lone])
+        else:
+            grown.extend([first >> widest << (widest + 32) | (first | ((1 << widest) - 1)) for first in lone])
+        # the rest are counted bottom up: the addresses at /31 once, then
+        # each level from the one below, plus the wider ranges that first
+        # fit in one block at that level. Below that level a range reaches
+        # into two or more blocks; those it covers whole are listed already,
+        # but it also adds to the blocks it only partly covers at its ends
+        home = dict()
+        ends = dict()
+        for (first, last) in wider:
+            prefix = 32 - (first ^ last).bit_length()
+            if prefix >= min_prefix:
+                home.setdefault(prefix, list()).append((first >> (32 - prefix), last - first + 1))
+            if not (first | ~last) & ((1 << (31 - prefix)) - 1):
+                # starts and ends on a boundary at every level below that
+                continue
+            for level in range(31, max(prefix, min_prefix - 1), -1):
+                mask = (1 << (32 - level)) - 1
+                if first & mask:
+                    ends.setdefault(level, list()).append((first >> (32 - level), mask + 1 - (first & mask)))
+                if ~last & mask:
+                    ends.setdefault(level, list()).append((last >> (32 - level), (last & mask) + 1))
+        counts = Counter([first >> 1 for first in singles])
+        for prefix in range(31, min_prefix - 1, -1):
+            shift = 32 - prefix
+            if prefix < 31:
+                below = counts
+                counts = Counter()
+                for (block, n) in below.items():
+                    counts[block >> 1] += n
+            for (block, n) in home.get(prefix, ()):
+                counts[block] += n
+            covered = counts
+            if prefix in ends:
+                covered = Counter(counts)
+                for (block, n) in ends[prefix]:
+                    covered[block] += n
+            need = (1 << shift) * threshold / 100.0
+            # packed as for merge_ranges(): block start << 32 | block end
+            grown.extend([b << (shift + 32) | (((b + 1) << shift) - 1) for (b, n) in covered.items() if n >= need])
+        # the lone addresses are in grown already, as themselves or their block
+        ranges = merge_ranges([first << 32 | first for first in singles] + [first << 32 | last for (first, last) in wider] + grown)
+    prefixes = list()
+    ntoa = socket.inet_ntoa
+    for (first, last) in ranges:
+        if first == last:
+            prefixes.append(ntoa(first.to_bytes(4, 'big')) + '/32')
+            continue
+        size = last - first + 1
+        if not size & (size - 1) and not first & (size - 1):
+            # a single block, as most grown ones are
+            prefixes.append(ntoa(first.to_bytes(4, 'big')) + '/' + str(33 - size.bit_length()))
+            continue
+        prefixes.extend('{0}/{1}'.format(socket.inet_ntoa(net.to_bytes(4, 'big')), plen)
+                        for (net, plen) in range_to_prefixes(first, last))
+    return (prefixes, skipped)
+
+
+def read_blocklist(path, name=None, threshold=None):
+    """
+    Read a blocklist file: one IPv4 address or CIDR per line, with blank
+    lines and '#' comments ignored, aggregated with aggregate_cidrs().
+    The set is always hash:net, single addresses as /32s, so its type does
+    not change when the list gains or loses a network (ipset cannot swap
+    sets of different types).
+
+    Args:
+        path (str): the file to read
+        name (str): the ipset name; by default 'block-' and the file name
+            without its extension
+        threshold (float): the aggregate_cidrs() threshold, if any
+
+    Returns:
+        (blocklist, listed, skipped): a Blocklist, the number of entries
+            read, and the number of IPv6 or unparseable ones left out
+    """
+    if not name:
+        name = 'block-' + os.path.splitext(os.path.basename(path))[0]
+    name = name[:IPSET_NAME_MAX - len(IPSET_TMP_SUFFIX)]
+    entries = list()
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                entries.append(line)
+    (prefixes, skipped) = aggregate_cidrs(entries, threshold)
+    return (Blocklist(name, 'hash:net', prefixes), len(entries), skipped)
+
+
+def ipset_create(name, settype, size):
+    """
+    Returns:
+        line (str): an ipset restore 'create' line sized for size entries
+    """
+    maxelem = 65536
+    while maxelem < size:
+        maxelem *= 2
+    hashsize = 1024
+    while hashsize * 4 < size:
+        hashsize *= 2
+    return "create {0} {1} family inet hashsize {2} maxelem {3}".format(name, settype, hashsize, maxelem)
+
+
+def render_ipset_restore(blocklist, exists=False, swap=True):
+    """
+    Render the `ipset restore` input that replaces a set's contents in one
+    go: the entries are loaded into a temporary set, which is then
+    swapped with the live one and destroyed, so the live set is never
+    empty or half loaded.
+
+    Args:
+        blocklist (Blocklist): the set to load
+        exists (bool): whether the live set already exists; if not, it is
+            created (empty) for the swap
+        swap (bool): whether to swap it in; if not, the temporary set is
+            left for render_ipset_swap()
+
+    Returns:
+        text (str)
+    """
+    tmp = blocklist.name + IPSET_TMP_SUFFIX
+    lines = [ipset_create(tmp, blocklist.settype, len(blocklist.entries))]
+    lines.extend('add {0} {1}'.format(tmp, e) for e in blocklist.entries)
+    if not exists:
+        lines.append(ipset_create(blocklist.name, blocklist.settype, len(blocklist.entries)))
+    text = '\n'.join(lines) + '\n'
+    if swap:
+        text += render_ipset_swap(blocklist)
+    return text
+
+
+def render_ipset_swap(blocklist):
+    """
+    Returns:
+        text (str): the `ipset restore` input that swaps the temporary set
+            render_ipset_restore() loaded with the live one and destroys it
+    """
+    tmp = blocklist.name + IPSET_TMP_SUFFIX
+    return 'swap {0} {1}\ndestroy {0}\n'.format(tmp, blocklist.name)
+
+
+def load_ipsets(blocklists, swap=True):
+    """
+    Load the blocklists into their ipsets with one `ipset restore` run.
+    With swap off, the entries only go into the temporary sets (the live
+    ones are created, empty, if missing, so rules can reference them),
+    and swap_ipsets() puts them in place later.
+
+    Raises:
+        ValueError: if a live set has a different type than its new
+            contents (ipset cannot swap those), e.g. a hash:ip set made by
+            an older version of this script
+        subprocess.CalledProcessError: if ipset fails
+    """
+    names = subprocess.run(['ipset', 'list', '-n'], check=True, capture_output=True, text=True).stdout.split()
+    text = ''
+    for b in blocklists:
+        if b.name in names:
+            out = subprocess.run(['ipset', 'list', '-t', b.name], check=True, capture_output=True, text=True).stdout
+            settype = next((l.split(':', 1)[1].strip() for l in out.splitlines() if l.startswith('Type:')), None)
+            if settype != b.settype:
+                raise ValueError("ipset {0} is {1}, not {2}; remove its rule and destroy it first".format(b.name, settype, b.settype))
+        if b.name + IPSET_TMP_SUFFIX in names:
+            # left over from a failed run
+            text += 'destroy {0}{1}\n'.format(b.name, IPSET_TMP_SUFFIX)
+        text += render_ipset_restore(b, exists=b.name in names, swap=swap)
+    subprocess.run(['ipset', 'restore'], input=text, check=True, capture_output=True, text=True)
+
+
+def swap_ipsets(blocklists):
+    """
+    Swap in the blocklists load_ipsets(swap=False) loaded, in one `ipset
+    restore` run.
+
+    Raises:
+        subprocess.CalledProcessError: if ipset fails
+    """
+    text = ''.join(render_ipset_swap(b) for b in blocklists)
+    subprocess.run(['ipset', 'restore'], input=text, check=True, capture_output=True, text=True)
+
+
+def parse_notrack(values):
+    """
+    Parse --notrack values: 'udp/53', 'tcp/179', 'udp/1000:2000'.
+
+    Returns:
+        notrack (list): (proto, port) tuples
+
+    Raises:
+        ValueError: for anything else
+    """
+    notrack = list()
+    for value in values:
+        (proto, _, port) = value.partition('/')
+        if proto not in ('tcp', 'udp') or not all(p.isdigit() for p in port.split(':', 1)):
+            raise ValueError("bad --notrack value {0!r}; use e.g. udp/53".format(value))
+        notrack.append((proto, port))
+    return notrack
+
+
+def plan_rules(rules, notrack=()):
+    """
+    The planning stage: put the conntrack fast path at the top of INPUT,
+    OUTPUT and FORWARD (dropping any other copy of it further down), so
+    nearly every packet matches the first rule it is checked against.
+    The untracked packets of the stateless ports, which the rest of
+    INPUT would drop, are accepted ahead of its first conntrack state
+    check, which is after the anti-spoofing and blocklist drops: only
+    established traffic may skip those.
+
+    Args:
+        rules (dict): chain -> list of iptc.easy rule dicts, changed in place
+        notrack (list): (proto, port) of the stateless services
+
+    Returns:
+        rules (dict)
+    """
+    for chain in FAST_PATH_CHAINS:
+        rules[chain] = [FAST_PATH] + [r for r in rules.setdefault(chain, list()) if r != FAST_PATH]
+    n = next((n for (n, r) in enumerate(rules['INPUT'][1:], 1) if 'conntrack' in r), len(rules['INPUT']))
+    for (n, (proto, port)) in enumerate(notrack, n):
+        rules['INPUT'].insert(n, {'protocol': proto, proto: {'dport': port}, 'conntrack': {'ctstate': 'UNTRACKED'}, 'target': 'ACCEPT'})
+    return rules
+
+
+def head_length(specs):
+    """
+    Returns:
+        n (int): how many of the rules at the top of a chain plan_rules()
+            put there, i.e. the fast path, which must stay ahead of
+            everything else
+    """
+    return 1 if specs and specs[0] == FAST_PATH else 0
+
+
+def build_raw_rules(notrack):
+    """
+    Generate the raw table rules that take the stateless services out of
+    connection tracking, so a flood of, say, DNS queries cannot fill the
+    conntrack table and get other new connections dropped: requests
+    coming in are not tracked in PREROUTING, nor our replies in OUTPUT.
+
+    Returns:
+        rules (dict): chain -> list of iptc.easy rule dicts
+    """
+    rules = {'PREROUTING': list(), 'OUTPUT': list()}
+    for (proto, port) in notrack:
+        rules['PREROUTING'].append({'protocol': proto, proto: {'dport': port}, 'target': {'CT': {'notrack': ''}}})
+        rules['OUTPUT'].append({'protocol': proto, proto: {'sport': port}, 'target': {'CT': {'notrack': ''}}})
+    return rules
+
+
+def build_rules(ifaces, tcp_ports=('22',), udp_ports=(), blocklists=(), notrack=()):
+    """
+    Generate the rules for a simple stateful firewall: loopback and
+    established traffic is accepted, new TCP and UDP connections are
+    sent to the TCP and UDP chains, which accept the listed ports, and
+    anything else is logged (rate limited) and dropped.
+
+    Args:
+        ifaces (list): the network interfaces, not including lo
+        tcp_ports (list): ports or port ranges ('1000:2000') to accept TCP
+            on, e.g. the listener_ports() of get_listeners()
+        udp_ports (list): ports or port ranges to accept UDP on
+        blocklists (list): Blocklists whose sources are dropped, each with
+            one -m set --match-set rule
+        notrack (list): (proto, port) of the stateless services, whose
+            untracked packets are accepted; see build_raw_rules()
+
+    Returns:
+        (policies, rules): chain -> policy for the built-in chains, and
+            chain -> list of iptc.easy rule dicts, for every chain in
+            FILTER_CHAINS
+    """
+    policies = {'INPUT': 'DROP', 'OUTPUT': 'ACCEPT', 'FORWARD': 'DROP'}
+    rules = {chain: list() for chain in FILTER_CHAINS}
+
+    # anything coming in from lo, allow; anything claiming to be from
+    # 127/8 on another interface is spoofed
+    rules['INPUT'].append({'in-interface': 'lo', 'target': 'ACCEPT'})
+    for iface in ifaces:
+        rules['INPUT'].append({'in-interface': iface, 'src': '127.0.0.0/8', 'target': 'DROP'})
+    # one hashed set lookup per blocklist, however long it is
+    for b in blocklists:
+        rules['INPUT'].append({'set': {'match-set': '{0} src'.format(b.name)}, 'target': 'DROP'})
+    rules['INPUT'].append({'conntrack': {'ctstate': 'INVALID'}, 'target': 'DROP'})
+    rules['INPUT'].append({'protocol': 'icmp', 'icmp': {'icmp-type': '8'}, 'conntrack': {'ctstate': 'NEW'}, 'target': 'ACCEPT'})
+    rules['INPUT'].append({'protocol': 'udp', 'conntrack': {'ctstate': 'NEW'}, 'target': {'goto': 'UDP'}})
+    rules['INPUT'].append({'protocol': 'tcp', 'tcp': {'tcp-flags': 'FIN,SYN,RST,ACK SYN'}, 'conntrack': {'ctstate': 'NEW'}, 'target': {'goto': 'TCP'}})
+    rules['INPUT'].append({'target': 'LOGGING'})
+
+    for port in tcp_ports:
+        rules['TCP'].append({'protocol': 'tcp', 'tcp': {'dport': str(port)}, 'target': 'ACCEPT'})
+    for port in udp_ports:
+        rules['UDP'].append({'protocol': 'udp', 'udp': {'dport': str(port)}, 'target': 'ACCEPT'})
+    # fall through from TCP and UDP to the log-and-drop chain
+    rules['TCP'].append({'target': 'LOGGING'})
+    rules['UDP'].append({'target': 'LOGGING'})
+
+    rules['LOGGING'].append({'limit': {'limit': '5/min'}, 'target': {'LOG': {'log-prefix': 'iptables-dropped: ', 'log-level': '4'}}})
+    rules['LOGGING'].append({'target': 'DROP'})
+
+    # the fast path goes in the planning stage, above everything else
+    return (policies, plan_rules(rules, notrack))
+
+
+def restore_quote(value):
+    """
+    Returns:
+        value (str): value, double quoted for iptables-restore if needed
+    """
+    value = str(value)
+    if value and not any(c in value for c in ' "\'\\'):
+        return value
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def restore_opts(opts):
+    """
+    Returns:
+        args (list): '--option value' for each iptc.easy option; values
+            with several words (tcp-flags, match-set) give several
+            arguments, and empty ones none
+    """
+    args = list()
+    for (opt, value) in opts.items():
+        args.append('--' + opt)
+        if opt in TEXT_OPTS:
+            args.append(restore_quote(value))
+        elif value != '':
+            args.extend(restore_quote(v) for v in str(value).split(' '))
+    return args
+
+
+def rule_to_restore(chain, spec):
+    """
+    Turn an iptc.easy rule dict into an iptables-restore line, the way
+    iptables-save would print it.
+
+    Returns:
+        line (str)
+    """
+    args = ['-A', chain]
+    for (key, opt) in BASIC_KEYS.items():
+        if key in spec:
+            args.extend([opt, restore_quote(spec[key])])
+    for (key, value) in spec.items():
+        if key in BASIC_KEYS or key == 'target':
+            continue
+        args.extend(['-m', key] + restore_opts(value))
+    target = spec.get('target')
+    if isinstance(target, dict):
+        (name, opts) = next(iter(target.items()))
+        if name == 'goto':
+            args.extend(['-g', opts])
+        else:
+            args.extend(['-j', name] + restore_opts(opts))
+    elif target:
+        args.extend(['-j', target])
+    return ' '.join(args)
+
+
+def render_restore(tables):
+    """
+    Render generated rules as one iptables-restore file, with no need
+    for root or the kernel. Loaded without --noflush, each table in it
+    is replaced as a whole, atomically.
+
+    Args:
+        tables (list): (table, policies, rules) for each table, as from
+            build_rules() and build_raw_rules()
+
+    Returns:
+        text (str)
+    """
+    lines = list()
+    for (table, policies, rules) in tables:
+        builtin = BUILTIN_CHAINS[table]
+        lines.append('*' + table)
+        for name in builtin:
+            lines.append(':{0} {1} [0:0]'.format(name, policies.get(name, 'ACCEPT')))
+        for name in rules:
+            if name not in builtin:
+                lines.append(':{0} - [0:0]'.format(name))
+        for (name, specs) in rules.items():
+            lines.extend(rule_to_restore(name, spec) for spec in specs)
+        lines.append('COMMIT')
+    return '\n'.join(lines) + '\n'
+
+
+def nft_name(name):
+    """
+    Returns:
+        name (str): name, usable as an nftables set or chain name
+    """
+    return name.replace('-', '_')
+
+
+def nft_elements(values):
+    """
+    Returns:
+        text (str): an nftables element list; port ranges given
+            iptables-style (1000:2000) become 1000-2000
+    """
+    return '{ ' + ', '.join(str(v).replace(':', '-') for v in values) + ' }'
+
+
+def render_nft(ifaces, tcp_ports=('22',), udp_ports=(), blocklists=(), notrack=(), table=NFT_TABLE):
+    """
+    Render the policy of build_rules() as one nftables ruleset, for
+    `nft -f`. The ports to accept and the blocklists become named sets,
+    which the kernel looks up by hash (or interval tree) instead of
+    walking one rule per entry, and the conntrack state and the TCP/UDP
+    dispatch are verdict maps. As with plan_rules(), the conntrack fast
+    path comes first, and the stateless ports skip conntrack from a
+    chain at the raw priority.
+
+    The table is declared, deleted and defined again in the same file,
+    so loading it replaces it in one transaction and leaves other tables
+    alone. It is an ip table: the iptables policy is IPv4 only, and an
+    inet one would need ICMPv6 rules to keep IPv6 working.
+
+    Args:
+        see build_rules()
+        table (str): the nftables table name
+
+    Returns:
+        text (str)
+    """
+    lines = [
+        'table ip {0}'.format(table),
+        'delete table ip {0}'.format(table),
+        '',
+        'table ip {0} {{'.format(table),
+    ]
+    notrack_ports = {proto: [port for (p, port) in notrack if p == proto] for proto in ('tcp', 'udp')}
+    sets = [('tcp_ports', tcp_ports), ('udp_ports', udp_ports)]
+    sets.extend(('notrack_' + proto, ports) for (proto, ports) in sorted(notrack_ports.items()) if ports)
+    for (name, ports) in sets:
+        lines.append('    set {0} {{'.format(name))
+        lines.append('        type inet_service')
+        lines.append('        flags interval')
+        if ports:
+            lines.append('        elements = ' + nft_elements(ports))
+        lines.append('    }')
+    for b in blocklists:
+        lines.append('    set {0} {{'.format(nft_name(b.name)))
+        lines.append('        type ipv4_addr')
+        if b.settype == 'hash:net':
+            lines.append('        flags interval')
+        if b.entries:
+            lines.append('        elements = ' + nft_elements(b.entries))
+        lines.append('    }')
+
+    lines.append('    chain LOGGING {')
+    lines.append('        limit rate 5/minute log prefix "iptables-dropped: " level warn')
+    lines.append('        drop')
+    lines.append('    }')
+    lines.append('    chain TCP {')
+    lines.append('        tcp dport @tcp_ports accept')
+    lines.append('        jump LOGGING')
+    lines.append('    }')
+    lines.append('    chain UDP {')
+    lines.append('        udp dport @udp_ports accept')
+    lines.append('        jump LOGGING')
+    lines.append('    }')
+
+    if notrack:
+        for (chain, hook, way) in (('PREROUTING_RAW', 'prerouting', 'dport'), ('OUTPUT_RAW', 'output', 'sport')):
+            lines.append('    chain {0} {{'.format(chain))
+            lines.append('        type filter hook {0} priority raw;'.format(hook))
+            for proto in sorted(p for p in notrack_ports if notrack_ports[p]):
+                lines.append('        {0} {1} @notrack_{0} notrack'.format(proto, way))
+            lines.append('    }')
+
+    fast_path = '        ct state vmap { established : accept, related : accept }'
+    lines.append('    chain INPUT {')
+    lines.append('        type filter hook input priority filter; policy drop;')
+    lines.append(fast_path[:-2] + ', invalid : drop }')
+    lines.append('        iifname "lo" accept')
+    if ifaces:
+        lines.append('        iifname ' + nft_elements('"{0}"'.format(i) for i in ifaces) + ' ip saddr 127.0.0.0/8 drop')
+    for b in blocklists:
+        lines.append('        ip saddr @{0} drop'.format(nft_name(b.name)))
+    for proto in sorted(p for p in notrack_ports if notrack_ports[p]):
+        lines.append('        ct state untracked {0} dport @notrack_{0} accept'.format(proto))
+    lines.append('        icmp type echo-request ct state new accept')
+    lines.append('        tcp flags & (fin | syn | rst | ack) != syn jump LOGGING')
+    lines.append('        ct state new meta l4proto vmap { tcp : goto TCP, udp : goto UDP }')
+    lines.append('        jump LOGGING')
+    lines.append('    }')
+    lines.append('    chain FORWARD {')
+    lines.append('        type filter hook forward priority filter; policy drop;')
+    lines.append(fast_path)
+    lines.append('    }')
+    lines.append('    chain OUTPUT {')
+    lines.append('        type filter hook output priority filter; policy accept;')
+    lines.append(fast_path)
+    lines.append('    }')
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def apply_nft(text, check=False):
+    """
+    Load an nftables ruleset with `nft -f -`, which applies the whole
+    file as one transaction, or only check it with `nft -c`.
+    """
+    cmd = ['nft', '-c', '-f', '-'] if check else ['nft', '-f', '-']
+    subprocess.run(cmd, input=text, check=True, capture_output=True, text=True)
+
+
+def apply_rules(policies, rules, flush=False, verbose=False, table_name='filter'):
+    """
+    Write the generated rules to a table ('filter', 'raw') in one
+    transaction.
+
+    Our own chains are created if missing and always flushed first, and
+    the built-in chains are flushed if asked to; otherwise rules already
+    in a built-in chain are not added again, except the head of the chain
+    (see head_length()): any copies of those rules are deleted and they
+    are inserted at the top, so the fast path stays first. The other
+    missing rules are inserted after the rule that comes before them in
+    the plan, and ours found ahead of that are moved there, so e.g. the
+    untracked accepts end up after the blocklist drops. Nothing
+    reaches the kernel until the single table.commit() at the end, so a
+    failure part way through leaves the running firewall as it was.
+
+    Returns:
+        added (int): the number of rules written
+    """
+    import iptc
+    import iptc.easy
+
+    table = iptc.Table(table_name)
+    table.autocommit = False
+    added = 0
+    try:
+        chains = dict()
+        for name in rules:
+            if table.is_chain(name):
+                chains[name] = iptc.Chain(table, name)
+            else:
+                chains[name] = table.create_chain(name)
+            if name in USER_CHAINS or flush:
+                chains[name].flush()
+        for name in rules:
+            chain = chains[name]
+            specs = rules[name]
+            n = head_length(specs)
+            head = [iptc.easy.encode_iptc_rule(spec) for spec in specs[:n]]
+            current = list(head)
+            for rule in chain.rules:
+                if rule in head:
+                    chain.delete_rule(rule)
+                else:
+                    current.append(rule)
+            for rule in reversed(head):
+                chain.insert_rule(rule, 0)
+                added += 1
+            # current mirrors the chain, and at is where the next rule goes
+            at = n
+            for spec in specs[n:]:
+                rule = iptc.easy.encode_iptc_rule(spec)
+                if rule in current[at:]:
+                    at = current.index(rule, at) + 1
+                    continue
+                if rule in current:
+                    chain.delete_rule(rule)
+                    current.remove(rule)
+                    at -= 1
+                if at == len(current):
+                    chain.append_rule(rule)
+                else:
+                    chain.insert_rule(rule, at)
+                current.insert(at, rule)
+                at += 1
+                added += 1
+            if verbose:
+                cprint("{0} {1}: {2} rules".format(table_name, name, len(rules[name])), "green")
+        for (name, policy) in policies.items():
+            chains[name].set_policy(policy)
+        table.commit()
+    except Exception:
+        # drop the pending changes: with autocommit off, refresh() reloads
+        # the table from the kernel without writing anything
+        table.refresh()
+        raise
+    finally:
+        table.autocommit = True
+    return added
+
+
 def main():
-    # if we're not rot, we can't do much so check then exit if not root
-    if not is_root():
-        cprint("ERROR: This script must be run as root.", "red")
-        print("Example: sudo python3 setupfw.py")
-        exit(1)
     # allow for prettyy printing of objects
     pp = pprint.PrettyPrinter(indent=4)
 
@@ -62,26 +972,145 @@ def main():
     vqd.add_argument('-q', '--quiet', dest="quiet", required=False, action="store_true", help="Suppress output verbosity.")
     vqd.add_argument('--debug', dest="debug", required=False, action="store_true", help="Enable debug output verbosity.")
     parser.add_argument('-F', '--flush', dest="flush", required=False, action="store_true", help="Flush existing iptables rules before applying new ones.")
+    parser.add_argument('-t', '--tcp-port', dest="tcp_ports", required=False, action="append", help="Accept new TCP connections on this port or port range (repeatable; default: 22).")
+    parser.add_argument('-u', '--udp-port', dest="udp_ports", required=False, action="append", help="Accept UDP on this port or port range (repeatable).")
+    parser.add_argument('-N', '--no-detect', dest="no_detect", required=False, action="store_true", help="Do not open the ports of services already listening on the system (UDP ones in the ephemeral port range are taken for clients and left out).")
+    parser.add_argument('-b', '--blocklist', dest="blocklists", required=False, action="append", metavar="[NAME=]FILE", help="Drop the addresses and networks listed in FILE, through the ipset NAME (repeatable; default name: block-FILE).")
+    parser.add_argument('--aggregate-threshold', dest="threshold", required=False, type=float, default=None, metavar="PCT", help="Block a whole prefix, up to a /{0}, when at least PCT%% of its addresses are in a blocklist.".format(AGGREGATE_MIN_PREFIX))
+    parser.add_argument('--proc', dest="proc", required=False, default='/proc', help="Where to read the listening sockets from (default: %(default)s).")
+    parser.add_argument('--notrack', dest="notrack", required=False, action="append", metavar="PROTO/PORT", help="Accept this stateless service (e.g. udp/53, udp/123) without connection tracking, via the raw table (repeatable).")
+    parser.add_argument('-B', '--backend', dest="backend", required=False, choices=['iptables', 'nftables'], default='iptables', help="Write the rules with iptables (python-iptables and ipset) or as one nftables ruleset (default: %(default)s).")
+    parser.add_argument('-o', '--restore-file', dest="restore_file", required=False, help="With --backend iptables, only write the rules to this iptables-restore file ('-' for stdout) instead of changing the running firewall; this does not need root. Blocklist sets are not loaded.")
+    parser.add_argument('--nft-file', dest="nft_file", required=False, help="With --backend nftables, only write the ruleset to this file ('-' for stdout) instead of loading it; this does not need root.")
     args = parser.parse_args()
+    if args.restore_file and args.backend != 'iptables':
+        parser.error("--restore-file needs --backend iptables")
+    if args.nft_file and args.backend != 'nftables':
+        parser.error("--nft-file needs --backend nftables")
 
-    tcp_chain = iptc.Chain(iptc.Table(iptc.Table.FILTER), "TCP")
-    udp_chain = iptc.Chain(iptc.Table(iptc.Table.FILTER), 'UDP')
-    log_chain = iptc.Chain(iptc.Table(iptc.Table.FILTER), 'LOGGING')
-    inp_chain = iptc.Chain(iptc.Table(iptc.Table.FILTER), 'INPUT')
-    out_chain = iptc.Chain(iptc.Table(iptc.Table.FILTER), 'OUTPUT')
-    fwd_chain = iptc.Chain(iptc.Table(iptc.Table.FILTER), 'FORWARD')
-
-    # anything coming in from lo, allow
-    rule = iptc.Rule()
-    rule.in_interface = 'lo'
-    t = rule.create_target("ACCEPT")
+    # if we're not root, we can't do much so check then exit if not root,
+    # unless we are only rendering a file
+    if not is_root() and not (args.nft_file or args.restore_file):
+        cprint("ERROR: This script must be run as root.", "red")
+        print("Example: sudo python3 setupfw.py")
+        exit(1)
 
-    pp.pprint(dir(inp_chain.table))
+    try:
+        notrack = parse_notrack(args.notrack or [])
+    except ValueError as err:
+        parser.error(str(err))
 
     ifaces = get_ifaces()
-    pp.pprint(ifaces)
+    if args.debug:
+        pp.pprint(ifaces)
+
+    tcp_ports = list(args.tcp_ports or [])
+    udp_ports = list(args.udp_ports or [])
+    if not args.no_detect:
+        listeners = get_listeners(args.proc, processes=args.verbose or args.debug)
+        if args.verbose or args.debug:
+            for l in listeners:
+                cprint("Listening: {0} {1} port {2} ({3})".format(
+                    l.proto, l.addr, l.port, ', '.join('{1}[{0}]'.format(*p) for p in l.procs) or 'unknown'), "yellow")
+        tcp_ports += [p for p in listener_ports(listeners, 'tcp') if p not in tcp_ports]
+        udp_ports += [p for p in listener_ports(listeners, 'udp') if p not in udp_ports]
+
+    blocklists = list()
+    for arg in args.blocklists or []:
+        (name, path) = arg.split('=', 1) if '=' in arg else (None, arg)
+        try:
+            (blocklist, listed, skipped) = read_blocklist(path, name, args.threshold)
+        except OSError as err:
+            cprint("ERROR: {0}".format(err), "red")
+            exit(1)
+        if skipped and not args.quiet:
+            cprint("WARNING: {0}: skipped {1} IPv6 or invalid entries".format(path, skipped), "yellow")
+        if args.verbose or args.debug:
+            cprint("{0}: {1} entries aggregated to {2} {3} entries".format(blocklist.name, listed, len(blocklist.entries), blocklist.settype), "green")
+        blocklists.append(blocklist)
+
+    if args.backend == 'nftables':
+        text = render_nft(ifaces, tcp_ports or ['22'], udp_ports, blocklists, notrack)
+        if args.debug:
+            print(text)
+        try:
+            if args.nft_file == '-':
+                print(text, end='')
+            elif args.nft_file:
+                with open(args.nft_file, 'w') as out:
+                    out.write(text)
+            else:
+                apply_nft(text)
+        except (OSError, subprocess.CalledProcessError) as err:
+            cprint("ERROR: the firewall was left unchanged: {0}".format(getattr(err, 'stderr', None) or err), "red")
+            exit(1)
+        if not args.quiet and not args.nft_file:
+            cprint("Loaded nftables table {0}.".format(NFT_TABLE), "green")
+        return
 
-    fwd_chain.set_policy(iptc.Policy.DROP)
+    if args.restore_file:
+        (policies, rules) = build_rules(ifaces, tcp_ports or ['22'], udp_ports, blocklists, notrack)
+        tables = [('filter', policies, rules)]
+        if notrack:
+            tables.append(('raw', {}, build_raw_rules(notrack)))
+        text = render_restore(tables)
+        try:
+            if args.restore_file == '-':
+                print(text, end='')
+            else:
+                with open(args.restore_file, 'w') as out:
+                    out.write(text)
+        except OSError as err:
+            cprint("ERROR: {0}".format(err), "red")
+            exit(1)
+        return
+
+    try:
+        import iptc
+    except ImportError as err:
+        cprint("ERROR: python-iptables is needed to change the running firewall: {0}".format(err), "red")
+        exit(1)
+
+    if blocklists:
+        # the sets must exist before any rule can reference them; the new
+        # entries are only swapped in once the rules are committed, so a
+        # failure before then leaves the live sets as they were
+        try:
+            load_ipsets(blocklists, swap=False)
+        except (OSError, ValueError, subprocess.CalledProcessError) as err:
+            cprint("ERROR: loading the blocklists failed: {0}".format(getattr(err, 'stderr', None) or err), "red")
+            exit(1)
+
+    (policies, rules) = build_rules(ifaces, tcp_ports or ['22'], udp_ports, blocklists, notrack)
+    raw_rules = build_raw_rules(notrack)
+    if args.debug:
+        pp.pprint(rules)
+        pp.pprint(raw_rules)
+
+    try:
+        added = apply_rules(policies, rules, args.flush, args.verbose or args.debug)
+    except (iptc.IPTCError, ValueError) as err:
+        cprint("ERROR: the firewall was left unchanged: {0}".format(err), "red")
+        exit(1)
+    if blocklists:
+        try:
+            swap_ipsets(blocklists)
+        except (OSError, subprocess.CalledProcessError) as err:
+            cprint("ERROR: the filter table was applied, but the blocklists were left unchanged: "
+                   "{0}".format(getattr(err, 'stderr', None) or err), "red")
+            exit(1)
+    # the filter table accepts untracked packets before the raw table
+    # starts making them, so nothing is dropped in between; each table is
+    # its own transaction, though, so the filter rules stay if this fails
+    if notrack:
+        try:
+            added += apply_rules({}, raw_rules, args.flush, args.verbose or args.debug, iptc.Table.RAW)
+        except (iptc.IPTCError, ValueError) as err:
+            cprint("ERROR: the filter table was applied, but the raw table was left unchanged, "
+                   "so the --notrack ports are still tracked: {0}".format(err), "red")
+            exit(1)
+    if not args.quiet:
+        cprint("Added {0} rules.".format(added), "green")
 
 
 if __name__=='__main__':
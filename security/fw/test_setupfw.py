@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+test_setupfw.py
+
+Check setupfw.aggregate_cidrs() against a brute-force count: with a
+threshold, every block from /31 to /min_prefix of which at least that
+share of addresses is listed must be blocked whole, and nothing else
+added.
+
+Usage:
+  python3 -m unittest test_setupfw
+"""
+
+import os
+import sys
+import random
+import tempfile
+import unittest
+import ipaddress
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import setupfw
+
+
+def addresses(prefixes):
+    out = set()
+    for p in prefixes:
+        net = ipaddress.ip_network(p, strict=False)
+        first = int(net.network_address)
+        out.update(range(first, first + net.num_addresses))
+    return out
+
+
+def brute_force(entries, threshold, min_prefix):
+    """
+    Returns:
+        the addresses aggregate_cidrs() should block, counted block by
+        block from the listed addresses
+    """
+    listed = addresses(entries)
+    blocked = set(listed)
+    for prefix in range(31, min_prefix - 1, -1):
+        shift = 32 - prefix
+        counts = dict()
+        for a in listed:
+            counts[a >> shift] = counts.get(a >> shift, 0) + 1
+        for (block, n) in counts.items():
+            if n >= (1 << shift) * threshold / 100.0:
+                blocked.update(range(block << shift, (block + 1) << shift))
+    return blocked
+
+
+class AggregateTest(unittest.TestCase):
+
+    def test_range_across_blocks(self):
+        # 128 of the 256 addresses of 10.0.5.0/24, in ranges that each
+        # start or end in another block
+        entries = ['10.0.4.252/30', '10.0.5.0/26', '10.0.5.64/27', '10.0.5.96/28', '10.0.5.112/29',
+                   '10.0.5.120/30', '10.0.5.124/31', '10.0.5.126', '10.0.5.200']
+        (prefixes, skipped) = setupfw.aggregate_cidrs(entries, 50)
+        self.assertIn('10.0.5.0/24', prefixes)
+        self.assertEqual(skipped, 0)
+
+    def test_exact(self):
+        (prefixes, _) = setupfw.aggregate_cidrs(['10.0.0.1', '10.0.0.0', '10.0.0.2/31', '10.0.0.9'])
+        self.assertEqual(prefixes, ['10.0.0.0/30', '10.0.0.9/32'])
+
+    def test_brute_force(self):
+        rng = random.Random(1)
+        for _ in range(1000):
+            base = 0x0a000000 + rng.randrange(4) * 256
+            entries = list()
+            for _ in range(rng.choice([1, 3, 10, 40])):
+                entry = str(ipaddress.IPv4Address(base + rng.randrange(1024)))
+                if rng.random() < 0.4:
+                    entry += '/{0}'.format(rng.choice([31, 30, 29, 28, 27, 26, 25]))
+                entries.append(entry)
+            threshold = rng.choice([None, 1, 5, 10, 12.5, 25, 33, 40, 50, 60, 75, 100])
+            min_prefix = rng.choice([22, 24, 28])
+            (prefixes, _) = setupfw.aggregate_cidrs(entries, threshold, min_prefix)
+            expected = addresses(entries) if threshold is None else brute_force(entries, threshold, min_prefix)
+            self.assertEqual(addresses(prefixes), expected, (entries, threshold, min_prefix))
+
+
+class PlanTest(unittest.TestCase):
+
+    def test_untracked_after_drops(self):
+        blocklist = setupfw.Blocklist('bl', 'hash:net', ['192.0.2.0/24'])
+        (_, rules) = setupfw.build_rules(['eth0'], blocklists=[blocklist], notrack=[('udp', '53')])
+        targets = [r['target'] for r in rules['INPUT']]
+        untracked = [n for (n, r) in enumerate(rules['INPUT']) if r.get('conntrack') == {'ctstate': 'UNTRACKED'}]
+        self.assertEqual(untracked, [4])
+        self.assertEqual(targets[:4], ['ACCEPT', 'ACCEPT', 'DROP', 'DROP'])
+        self.assertEqual(setupfw.head_length(rules['INPUT']), 1)
+
+
+class ListenerTest(unittest.TestCase):
+
+    def test_udp_clients_skipped(self):
+        header = '  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n'
+        # a server on 0.0.0.0:53, and a client socket on 0.0.0.0:40000
+        udp = header + ('   1: 00000000:0035 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 101\n'
+                        '   2: 00000000:9C40 00000000:0000 07 00000000:00000000 00:00000000 00000000  1000        0 102\n')
+        with tempfile.TemporaryDirectory() as proc:
+            os.makedirs(os.path.join(proc, 'net'))
+            os.makedirs(os.path.join(proc, 'sys', 'net', 'ipv4'))
+            with open(os.path.join(proc, 'net', 'udp'), 'w') as f:
+                f.write(udp)
+            with open(os.path.join(proc, 'sys', 'net', 'ipv4', 'ip_local_port_range'), 'w') as f:
+                f.write('32768\t60999\n')
+            self.assertEqual(setupfw.listener_ports(setupfw.get_listeners(proc), 'udp'), ['53'])
+
+
+if __name__ == '__main__':
+    unittest.main()